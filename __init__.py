@@ -1,3 +1,3 @@
 __author__ = 'wynand'
 
-from hierarchy import Hierarchy
+from hierarchy import Hierarchy, CompactHierarchy
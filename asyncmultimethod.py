@@ -0,0 +1,156 @@
+__author__ = 'wynand'
+
+# Multimethods for trollius (asyncio for Python 2) event loops.
+#
+# Calling an AsyncMultiMethod returns a coroutine. The dispatch function and
+# the methods may return coroutines or futures, which are waited for in
+# turn. Whatever would take a lock happens in an executor, so the event loop
+# never blocks on one:
+#
+# * A call whose method can be read from the caches without locking (which
+#   is what copy on write and sealed multimethods are for) is dispatched
+#   right away, on the loop.
+# * Otherwise get_method runs in the executor. Calls on the same loop that
+#   need the same dispatch value meanwhile wait for that one resolution
+#   rather than starting their own.
+# * add_method_async, remove_method_async, prefer_method_async and
+#   derive_async make their changes in the executor too.
+# * So does the import of a method registered with add_lazy_method, which
+#   happens before its first call rather than during it.
+#
+# The synchronous add_method and friends still work, for registration before
+# the loop runs.
+
+from functools import partial
+
+import dispatchindex
+from multimethod import MultiMethod, _LazyMethod
+
+try:
+    import trollius
+    from trollius import From, Return
+except ImportError:
+    trollius = None
+
+
+def _coroutine(func):
+    # trollius.coroutine when there is a trollius to be had
+    if trollius is None:
+        return func
+    return trollius.coroutine(func)
+
+
+def _is_awaitable(value):
+    return trollius.iscoroutine(value) or isinstance(value, trollius.Future)
+
+
+def _unloaded(target_func):
+    # Whether target_func stands in for a method that is yet to be imported
+    return isinstance(target_func, _LazyMethod) and target_func.func is None
+
+
+class AsyncMultiMethod(MultiMethod):
+    def __init__(self, name, dispatch_func, default_dispatch_val, hierarchy, default_func=None, cache=None,
+                 factored=False, copy_on_write=None, executor=None, lock=None):
+        if trollius is None:
+            raise ImportError("Async multimethods need trollius")
+        super(AsyncMultiMethod, self).__init__(name, dispatch_func, default_dispatch_val, hierarchy, default_func,
+                                               cache, factored, copy_on_write, lock=lock)
+        # Where the work that takes locks goes; None is the loop's default executor
+        self.executor = executor
+        # (loop, dispatch value) -> future of its method, for resolutions under way
+        self._resolving = {}
+
+    def _cached_method(self, dispatch_val):
+        # The method for dispatch_val if it can be had without locking, else MISSING
+        if self.sealed:
+            try:
+                return self.sealed_methods[dispatch_val]
+            except KeyError:
+                pass
+        if self.copy_on_write:
+            source = self.snapshot
+            if source.hierarchy is not self.hierarchy.snapshot:
+                return dispatchindex.MISSING
+        else:
+            if self.hierarchy_version != self.hierarchy.__version__:
+                return dispatchindex.MISSING
+            source = self
+        if self.factored and isinstance(dispatch_val, tuple):
+            index = source.factored_index
+            target_func = dispatchindex.MISSING if index is None else index.cached_method(dispatch_val)
+        else:
+            target_func = source.method_cache.get(dispatch_val, dispatchindex.MISSING)
+        if target_func is dispatchindex.DEFAULT:
+            # Without a default method it is up to get_method to raise
+            return source.method_table.get(self.default_dispatch_val, dispatchindex.MISSING)
+        # None stands for the default method, which get_method looks up
+        return dispatchindex.MISSING if target_func is None else target_func
+
+    def _record_dispatch_vals(self, record):
+        # Dispatch functions may return coroutines here, so get_method_async
+        # does the recording instead, once it has the dispatch value
+        pass
+
+    def _in_executor(self, loop, func, *args):
+        return loop.run_in_executor(self.executor, partial(func, *args))
+
+    @_coroutine
+    def get_method_async(self, dispatch_val, loop=None):
+        rewarmer = self.rewarmer
+        if rewarmer is not None:
+            rewarmer.record(dispatch_val)
+        target_func = self._cached_method(dispatch_val)
+        if target_func is not dispatchindex.MISSING and not _unloaded(target_func):
+            raise Return(target_func)
+        if loop is None:
+            loop = trollius.get_event_loop()
+        key = (loop, dispatch_val)
+        future = self._resolving.get(key)
+        if future is None:
+            future = self._resolving[key] = self._in_executor(loop, self._get_loaded_method, dispatch_val)
+            future.add_done_callback(lambda _: self._resolving.pop(key, None))
+        # Shielded, so that a caller giving up does not cancel the others
+        target_func = yield From(trollius.shield(future, loop=loop))
+        raise Return(target_func)
+
+    def _get_loaded_method(self, dispatch_val):
+        # get_method, importing lazy methods rather than leaving that to their first call
+        target_func = self.get_method(dispatch_val)
+        if isinstance(target_func, _LazyMethod):
+            target_func = target_func.load()
+        return target_func
+
+    @_coroutine
+    def __call__(self, *args, **kwargs):
+        dispatch_val = self.dispatch_func(*args, **kwargs)
+        if _is_awaitable(dispatch_val):
+            dispatch_val = yield From(dispatch_val)
+        target_func = yield From(self.get_method_async(dispatch_val))
+        result = target_func(*args, **kwargs)
+        if _is_awaitable(result):
+            result = yield From(result)
+        raise Return(result)
+
+    @_coroutine
+    def add_method_async(self, dispatch_val, func, loop=None):
+        result = yield From(self._in_executor(loop or trollius.get_event_loop(), self.add_method(dispatch_val), func))
+        raise Return(result)
+
+    @_coroutine
+    def remove_method_async(self, dispatch_val, loop=None):
+        result = yield From(self._in_executor(loop or trollius.get_event_loop(), self.remove_method, dispatch_val))
+        raise Return(result)
+
+    @_coroutine
+    def prefer_method_async(self, dispatch_val_x, dispatch_val_y, loop=None):
+        result = yield From(self._in_executor(loop or trollius.get_event_loop(), self.prefer_method,
+                                              dispatch_val_x, dispatch_val_y))
+        raise Return(result)
+
+
+@_coroutine
+def derive_async(hierarchy, child, parent=None, loop=None, executor=None):
+    # hierarchy.derive(child, parent), in an executor
+    loop = loop or trollius.get_event_loop()
+    yield From(loop.run_in_executor(executor, partial(hierarchy.derive, child, parent)))
@@ -0,0 +1,375 @@
+__author__ = 'wynand'
+
+# Benchmarks for the dispatch hot paths. Run
+#
+#     python bench.py                      # everything, as a table
+#     python bench.py --json results.json  # and as JSON, for comparisons
+#     python bench.py cached cold --quick  # some of them, smaller and faster
+#
+# Every benchmark is timed --repeat times after a warm-up round, and the best
+# and median times per operation are reported. Workloads are generated from a
+# fixed seed, so runs are comparable across versions.
+
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+import dispatchspec
+from hierarchy import Hierarchy
+import methodcache
+import rwlock
+
+
+def _tree(h, count, fanout=4, prefix='n'):
+    # Derives count nodes named prefix0.. into a tree, returning their names
+    names = ['{0}{1}'.format(prefix, i) for i in xrange(count)]
+    with h.batch():
+        for i in xrange(1, count):
+            h.derive(names[i], names[(i - 1) // fanout])
+    return names
+
+
+def _leaves_method(h, names, every, lock=None):
+    # A multimethod with a method on every every-th node of names
+    @h.multimethod(lock=lock)
+    def method(x):
+        return None
+
+    with method.batch():
+        for i in xrange(0, len(names), every):
+            method.add_method(names[i])(lambda x, i=i: i)
+    return method
+
+
+def bench_cached(scale, variant):
+    # Warm single argument dispatch through __call__
+    h = Hierarchy(copy_on_write=variant == 'copy_on_write')
+    names = _tree(h, 64)
+    method = _leaves_method(h, names, 4)
+    if variant == 'sealed':
+        h.freeze()
+        method.seal()
+    values = [random.Random(0).choice(names) for _ in xrange(1000)]
+    if variant == 'specialized':
+        method = method.specialize(inline_cache_size=len(names))
+    for value in values:
+        method(value)
+    rounds = scale
+
+    def run():
+        for _ in xrange(rounds):
+            for value in values:
+                method(value)
+    return run, rounds * len(values)
+
+
+def bench_records(scale, variant):
+    # Warm dispatch on a pair of records by their 'type', through a lambda or
+    # a dispatch spec, and with specialize after the dash, or on a single
+    # record after '-single'
+    kind, _, specialized = variant.partition('-')
+    h = Hierarchy()
+    names = _tree(h, 32)
+    if specialized == 'single':
+        return _bench_record(scale, kind, h, names)
+    if kind == 'spec':
+        dispatch_func = (dispatchspec.key('type'), dispatchspec.key('type'))
+    else:
+        dispatch_func = lambda a, b: (a['type'], b['type'])
+
+    @h.multimethod(dispatch_func)
+    def method(a, b):
+        return None
+
+    r = random.Random(0)
+    for i in xrange(0, len(names), 4):
+        method.add_method((names[i], names[0]))(lambda a, b: 1)
+    pairs = [({'type': r.choice(names)}, {'type': r.choice(names)}) for _ in xrange(1000)]
+    if specialized:
+        method = method.specialize(inline_cache_size=len(pairs))
+    for a, b in pairs:
+        method(a, b)
+    rounds = scale
+
+    def run():
+        for _ in xrange(rounds):
+            for a, b in pairs:
+                method(a, b)
+    return run, rounds * len(pairs)
+
+
+def _bench_record(scale, kind, h, names):
+    if kind == 'spec':
+        dispatch_func = dispatchspec.key('type')
+    else:
+        dispatch_func = lambda a: a['type']
+
+    @h.multimethod(dispatch_func)
+    def method(a):
+        return None
+
+    for i in xrange(0, len(names), 4):
+        method.add_method(names[i])(lambda a: 1)
+    r = random.Random(0)
+    records = [{'type': r.choice(names)} for _ in xrange(1000)]
+    for record in records:
+        method(record)
+    rounds = scale
+
+    def run():
+        for _ in xrange(rounds):
+            for record in records:
+                method(record)
+    return run, rounds * len(records)
+
+
+def bench_tuple(scale, variant):
+    # Warm dispatch on a pair of arguments
+    h = Hierarchy()
+    names = _tree(h, 32)
+
+    @h.multimethod(lambda x, y: (x, y), factored=variant == 'factored')
+    def method(x, y):
+        return None
+
+    r = random.Random(0)
+    for i in xrange(0, len(names), 4):
+        method.add_method((names[i], names[r.randrange(len(names))]))(lambda x, y: 1)
+    pairs = [(r.choice(names), r.choice(names)) for _ in xrange(1000)]
+    if variant == 'specialized':
+        method = method.specialize(inline_cache_size=len(pairs))
+    for x, y in pairs:
+        method(x, y)
+    rounds = scale
+
+    def run():
+        for _ in xrange(rounds):
+            for x, y in pairs:
+                method(x, y)
+    return run, rounds * len(pairs)
+
+
+LOCKS = {'rwlock': rwlock.ReadWriteLock,
+         'counting': rwlock.CountingLock,
+         'phasefair': rwlock.PhaseFairLock,
+         'null': rwlock.NullLock}
+
+
+def bench_cold(scale, variant):
+    # Resolution of every node against a large method table, from an empty cache
+    h = Hierarchy(lock=LOCKS[variant]())
+    names = _tree(h, 400 * scale)
+    method = _leaves_method(h, names, 2, LOCKS[variant]())
+
+    def run():
+        with method.rw.write(), h.rw.read():
+            method._reset_cache()
+        for name in names:
+            method.get_method(name)
+    return run, len(names)
+
+
+def bench_stampede(scale, variant):
+    # Threads all missing on the same few dispatch values after the cache is
+    # cleared, variant being the number of threads
+    h = Hierarchy()
+    names = _tree(h, 2000)
+    method = _leaves_method(h, names, 2)
+    hot = names[-16:]
+    threads = int(variant)
+    rounds = 10 * scale
+
+    def caller():
+        for value in hot:
+            method(value)
+
+    def run():
+        for _ in xrange(rounds):
+            with method.rw.write(), h.rw.read():
+                method._reset_cache()
+            workers = [threading.Thread(target=caller) for _ in xrange(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    return run, rounds * threads * len(hot)
+
+
+def bench_megamorphic(scale, variant):
+    # Three arguments of 50 types each, called in random combinations
+    h = Hierarchy()
+    kinds = _tree(h, 50, fanout=7, prefix='k')
+    cache = methodcache.LRUCache(4096) if variant == 'lru' else None
+
+    @h.multimethod(lambda x, y, z: (x, y, z), cache=cache, factored=variant == 'factored')
+    def method(x, y, z):
+        return None
+
+    for kind in kinds[:8]:
+        method.add_method((kind, 'k0', 'k0'))(lambda x, y, z: 1)
+    r = random.Random(0)
+    triples = [(r.choice(kinds), r.choice(kinds), r.choice(kinds)) for _ in xrange(2000 * scale)]
+
+    def run():
+        for x, y, z in triples:
+            method(x, y, z)
+    return run, len(triples)
+
+
+def bench_invalidation(scale, variant):
+    # Calls interleaved with derives, each of which invalidates part of the cache
+    h = Hierarchy(copy_on_write=variant == 'copy_on_write')
+    names = _tree(h, 256)
+    method = _leaves_method(h, names, 8)
+    r = random.Random(0)
+    values = [r.choice(names) for _ in xrange(100)]
+    state = {'next': 0}
+    rounds = 10 * scale
+
+    def run():
+        for _ in xrange(rounds):
+            state['next'] += 1
+            h.derive('extra{0}'.format(state['next']), r.choice(names))
+            for value in values:
+                method(value)
+    return run, rounds * (len(values) + 1)
+
+
+def bench_rwlock(scale, variant):
+    # Read lock round trips from several threads at once, variant being the
+    # number of threads, after the kind of lock if not a ReadWriteLock
+    kind, _, threads = variant.rpartition('-')
+    lock = LOCKS[kind or 'rwlock']()
+    threads = int(threads)
+    per_thread = 2000 * scale
+
+    def reader():
+        for _ in xrange(per_thread):
+            with lock.read():
+                pass
+
+    def run():
+        workers = [threading.Thread(target=reader) for _ in xrange(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return run, threads * per_thread
+
+
+def bench_contention(scale, variant):
+    # Four threads dispatching while a fifth keeps deriving
+    if variant == 'copy_on_write':
+        h = Hierarchy(copy_on_write=True)
+        lock = None
+    else:
+        h = Hierarchy(lock=LOCKS[variant]())
+        lock = LOCKS[variant]()
+    names = _tree(h, 256)
+    method = _leaves_method(h, names, 8, lock)
+    per_thread = 2000 * scale
+    state = {'next': 0}
+
+    def reader(seed):
+        r = random.Random(seed)
+        for _ in xrange(per_thread):
+            method(r.choice(names))
+
+    def run():
+        done = threading.Event()
+
+        def writer():
+            r = random.Random(0)
+            while not done.is_set():
+                state['next'] += 1
+                h.derive('extra{0}'.format(state['next']), r.choice(names))
+                time.sleep(0.001)
+
+        writing = threading.Thread(target=writer)
+        writing.start()
+        workers = [threading.Thread(target=reader, args=(seed,)) for seed in xrange(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        done.set()
+        writing.join()
+    return run, 4 * per_thread
+
+
+BENCHMARKS = [
+    ('cached', bench_cached, ['plain', 'copy_on_write', 'sealed', 'specialized']),
+    ('tuple', bench_tuple, ['plain', 'factored', 'specialized']),
+    ('records', bench_records, ['lambda', 'spec', 'lambda-specialized', 'spec-specialized',
+                                   'lambda-single', 'spec-single']),
+    ('cold', bench_cold, ['rwlock', 'counting', 'phasefair', 'null']),
+    ('stampede', bench_stampede, ['1', '8']),
+    ('megamorphic', bench_megamorphic, ['plain', 'lru', 'factored']),
+    ('invalidation', bench_invalidation, ['plain', 'copy_on_write']),
+    ('rwlock', bench_rwlock, ['1', '4', 'counting-1', 'counting-4', 'phasefair-1', 'phasefair-4', 'null-1']),
+    ('contention', bench_contention, ['rwlock', 'counting', 'phasefair', 'copy_on_write']),
+]
+
+
+def measure(bench, scale, variant, repeat):
+    random.seed(0)
+    run, ops = bench(scale, variant)
+    run()
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    times.sort()
+    return {'ops': ops,
+            'repeat': repeat,
+            'best_us': times[0] / ops * 1e6,
+            'median_us': times[len(times) // 2] / ops * 1e6}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for multimethod dispatch')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all of them)')
+    parser.add_argument('--json', help='file to write the results to as JSON, - for stdout')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help='smaller workloads and fewer repeats')
+    args = parser.parse_args(argv)
+
+    scale = 1 if args.quick else 5
+    repeat = min(args.repeat, 3) if args.quick else args.repeat
+    unknown = set(args.names) - set(name for name, _, _ in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {0}'.format(', '.join(sorted(unknown))))
+
+    results = []
+    for name, bench, variants in BENCHMARKS:
+        if args.names and name not in args.names:
+            continue
+        for variant in variants:
+            result = measure(bench, scale, variant, repeat)
+            result.update(name=name, variant=variant)
+            results.append(result)
+            sys.stderr.write('{0:<14}{1:<16}{2:>10.3f} us/op  (median {3:.3f})\n'.format(
+                name, variant, result['best_us'], result['median_us']))
+
+    if args.json:
+        report = {'python': platform.python_version(),
+                  'implementation': platform.python_implementation(),
+                  'platform': platform.platform(),
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'scale': scale,
+                  'results': results}
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
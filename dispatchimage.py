@@ -0,0 +1,396 @@
+__author__ = 'wynand'
+
+# Read-only binary images of a hierarchy and the resolved dispatch tables of
+# its multimethods, for sharing between the processes of a worker pool.
+#
+# The parent process builds the hierarchy, registers its multimethods and
+# writes an image with write (or build, to get the bytes). Every worker then
+# opens the image with DispatchImage.open, which memory-maps it, so that all
+# of them share the same pages, and binds its own multimethods to it. A bound
+# multimethod looks dispatch values up in the image and only takes its
+# methods from its own method table, by key. Nothing the image holds is
+# copied into the worker: lookups read the mapped bytes in place. Putting the
+# file on a tmpfs such as /dev/shm makes it plain shared memory.
+#
+# Images hold the ancestor closure of every node (in compressed sparse row
+# form) and, per multimethod, the key that every node and every feasible
+# tuple of nodes (see MultiMethod.seal) resolves to. Nodes, dispatch values
+# and keys must be strings, numbers or tuples of those, which are stored
+# marshalled and found through an open addressing hash table. Images use the
+# native byte order and are meant for the machine that wrote them, and
+# offsets are 32 bits wide, which limits them to 2GB.
+
+from array import array
+from bisect import bisect_left
+from types import ClassType
+from zlib import crc32
+import json
+import marshal
+import mmap
+import struct
+
+from hierarchy import Hierarchy
+from multimethod import _default_method, _select_best_method
+
+MAGIC = 'MMIMAGE1'
+
+# Resolved key ids with special meanings
+_UNRESOLVED = -1
+_DEFAULT = -2
+
+_ID = struct.Struct('=i')
+
+
+def _normalize(value):
+    # Values that compare equal must encode the same, and ASCII unicode
+    # compares equal to str.
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, tuple):
+        return tuple(_normalize(component) for component in value)
+    return value
+
+
+def _encode(value):
+    # Raises ValueError for values an image cannot hold. Version 0 of the
+    # format does not tell interned strings apart from the rest.
+    return marshal.dumps(_normalize(value), 0)
+
+
+def _hash(encoded):
+    return crc32(encoded) & 0xffffffff
+
+
+class _Values(object):
+    # Assigns ids to the values that go into an image
+    def __init__(self):
+        self.ids = {}
+        self.encoded = []
+
+    def add(self, value):
+        encoded = _encode(value)
+        try:
+            return self.ids[encoded]
+        except KeyError:
+            value_id = self.ids[encoded] = len(self.encoded)
+            self.encoded.append(encoded)
+            return value_id
+
+
+def _take(hierarchy, multimethods, max_entries):
+    # The values, ancestors and resolved keys of an image, or None if the
+    # hierarchy changed while they were taken. Multimethods are locked
+    # before the hierarchy, as everywhere else, so the hierarchy cannot be
+    # held throughout.
+    values = _Values()
+    with hierarchy.rw.read():
+        version = hierarchy.__version__
+        nodes = []
+        try:
+            for node in hierarchy.ancestors:
+                # Nodes get the first ids; equal encodings would share one
+                if values.add(node) == len(nodes):
+                    nodes.append(node)
+        except ValueError:
+            raise ValueError("Only hierarchies of strings, numbers and tuples of them can be imaged")
+        ancestor_offsets = array('i', [0])
+        ancestors = array('i')
+        for node in nodes:
+            ancestors.extend(sorted(values.ids[_encode(ancestor)] for ancestor in hierarchy.ancestors[node]))
+            ancestor_offsets.append(len(ancestors))
+    resolved = []
+    for mm in multimethods:
+        with mm.rw.read(), hierarchy.rw.read():
+            if hierarchy.__version__ != version:
+                return None
+            keys = {}
+            for dispatch_val, key in mm._resolve_keys(mm._dispatch_universe(max_entries)):
+                try:
+                    keys[values.add(dispatch_val)] = _DEFAULT if key == mm.default_dispatch_val else values.add(key)
+                except ValueError:
+                    # Left for the multimethod itself to resolve
+                    pass
+        resolved.append(keys)
+    return values, len(nodes), ancestor_offsets, ancestors, resolved
+
+
+def build(hierarchy, multimethods, max_entries=100000):
+    # Returns the image of hierarchy and multimethods, which must all be
+    # multimethods on hierarchy with distinct names, as a string.
+    names = [mm.name for mm in multimethods]
+    if len(set(names)) != len(names):
+        raise ValueError("Multimethods in an image need distinct names")
+    for mm in multimethods:
+        if mm.hierarchy is not hierarchy:
+            raise ValueError("Multimethod '{0}' is not on this hierarchy".format(mm.name))
+    taken = None
+    while taken is None:
+        taken = _take(hierarchy, multimethods, max_entries)
+    values, node_count, ancestor_offsets, ancestors, resolved = taken
+
+    encoded = values.encoded
+    value_offsets = array('i', [0])
+    for value in encoded:
+        value_offsets.append(value_offsets[-1] + len(value))
+    capacity = 1
+    while capacity < 2 * len(encoded):
+        capacity *= 2
+    slots = array('i', [-1]) * capacity
+    for value_id, value in enumerate(encoded):
+        slot = _hash(value) & (capacity - 1)
+        while slots[slot] != -1:
+            slot = (slot + 1) & (capacity - 1)
+        slots[slot] = value_id
+    sections = [('value_offsets', value_offsets.tostring()),
+                ('values', ''.join(encoded)),
+                ('slots', slots.tostring()),
+                ('ancestor_offsets', ancestor_offsets.tostring()),
+                ('ancestors', ancestors.tostring())]
+    for name, keys in zip(names, resolved):
+        column = array('i', [_UNRESOLVED]) * len(encoded)
+        for value_id, key_id in keys.iteritems():
+            column[value_id] = key_id
+        sections.append(('resolved:' + name, column.tostring()))
+
+    # Section offsets count from the end of the header, which is padded to 8 bytes
+    header = {'nodes': node_count, 'values': len(encoded), 'capacity': capacity,
+              'multimethods': names, 'sections': {}}
+    offset = 0
+    for name, data in sections:
+        header['sections'][name] = [offset, len(data)]
+        offset += len(data) + (-len(data) % 8)
+    header = json.dumps(header)
+    start = len(MAGIC) + 4 + len(header)
+    start += -start % 8
+    parts = [MAGIC, struct.pack('=I', len(header)), header, '\0' * (start - len(MAGIC) - 4 - len(header))]
+    for name, data in sections:
+        parts.append(data)
+        parts.append('\0' * (-len(data) % 8))
+    return ''.join(parts)
+
+
+def write(path, hierarchy, multimethods, max_entries=100000):
+    with open(path, 'wb') as f:
+        f.write(build(hierarchy, multimethods, max_entries))
+
+
+class DispatchImage(object):
+    def __init__(self, buffer):
+        # buffer is anything struct.unpack_from can read an image from
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a dispatch image")
+        header_size, = struct.unpack_from('=I', buffer, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(buffer[start:start + header_size])
+        start += header_size
+        start += -start % 8
+        self.buffer = buffer
+        self.node_count = header['nodes']
+        self.value_count = header['values']
+        self.capacity = header['capacity']
+        self.names = header['multimethods']
+        self.sections = dict((name, start + offset) for name, (offset, _) in header['sections'].iteritems())
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def _id(self, section, i):
+        return _ID.unpack_from(self.buffer, self.sections[section] + 4 * i)[0]
+
+    def _encoded(self, value_id):
+        start = self.sections['values']
+        return self.buffer[start + self._id('value_offsets', value_id):
+                           start + self._id('value_offsets', value_id + 1)]
+
+    def value(self, value_id):
+        return marshal.loads(self._encoded(value_id))
+
+    def value_id(self, value):
+        # The id of value in the image, or None if it is not in there
+        try:
+            encoded = _encode(value)
+        except ValueError:
+            return None
+        mask = self.capacity - 1
+        slot = _hash(encoded) & mask
+        while True:
+            value_id = self._id('slots', slot)
+            if value_id == -1:
+                return None
+            if self._encoded(value_id) == encoded:
+                return value_id
+            slot = (slot + 1) & mask
+
+    def _ancestor_range(self, node_id):
+        return self._id('ancestor_offsets', node_id), self._id('ancestor_offsets', node_id + 1)
+
+    def ancestors(self, node):
+        # The ancestors of node, node included, as a frozenset
+        node_id = self.value_id(node)
+        if node_id is None or node_id >= self.node_count:
+            raise KeyError(node)
+        start, end = self._ancestor_range(node_id)
+        return frozenset(self.value(self._id('ancestors', i)) for i in xrange(start, end))
+
+    def is_node(self, value):
+        value_id = self.value_id(value)
+        return value_id is not None and value_id < self.node_count
+
+    def is_a(self, child, parent):
+        # Whether parent is among the ancestors of child, for nodes of the
+        # imaged hierarchy; False for anything else.
+        child_id = self.value_id(child)
+        parent_id = self.value_id(parent)
+        if child_id is None or parent_id is None or child_id >= self.node_count:
+            return False
+        start, end = self._ancestor_range(child_id)
+        i = bisect_left(_IdView(self, start), parent_id, 0, end - start)
+        return i < end - start and self._id('ancestors', start + i) == parent_id
+
+    def resolved_key(self, name, dispatch_val):
+        # The method table key that dispatch_val resolves to in multimethod
+        # name, as a (found, key) pair; key is None for the default method.
+        value_id = self.value_id(dispatch_val)
+        if value_id is None:
+            return False, None
+        key_id = self._id('resolved:' + name, value_id)
+        if key_id == _UNRESOLVED:
+            return False, None
+        if key_id == _DEFAULT:
+            return True, None
+        return True, self.value(key_id)
+
+    def bind(self, multimethod):
+        # Makes multimethod take its dispatch decisions from the image, and
+        # only the methods themselves from its own method table. The image
+        # stands in for the imaged hierarchy too: dispatch values it has not
+        # resolved, keys that the multimethod has no method for and
+        # everything once the methods or preferences of the multimethod
+        # change are resolved against the ancestors the image holds for its
+        # nodes, and those the multimethod's own hierarchy holds for
+        # anything else. So workers need not build the hierarchy at all.
+        name = multimethod.name
+        if name not in self.names:
+            raise KeyError("No multimethod '{0}' in the image".format(name))
+        multimethod.get_method = _Binding(self, multimethod).get_method
+        return multimethod
+
+
+class _ImageHierarchy(object):
+    # What a bound multimethod resolves against. Nodes of the image have the
+    # ancestors the image gives them, anything else those it has in the
+    # hierarchy of the multimethod; is_a is Hierarchy's, on top of that.
+    def __init__(self, image, hierarchy):
+        self.image = image
+        self.hierarchy = hierarchy
+
+    @property
+    def ancestors(self):
+        # Only consulted for classes, which are never nodes of an image
+        return self.hierarchy.ancestors
+
+    def _has_ancestor(self, node, ancestor):
+        # Raises KeyError if node is in neither
+        if self.image.is_node(node):
+            return self.image.is_a(node, ancestor)
+        return self.hierarchy._has_ancestor(node, ancestor)
+
+    is_a = Hierarchy.is_a.im_func
+
+
+class _Binding(object):
+    # The get_method of a multimethod bound to an image. Methods are kept
+    # per dispatch value, in a cache like the multimethod's own, which is
+    # emptied whenever its tables or its hierarchy change.
+    def __init__(self, image, multimethod):
+        self.image = image
+        self.multimethod = multimethod
+        self.section = 'resolved:' + multimethod.name
+        self.hierarchy = _ImageHierarchy(image, multimethod.hierarchy)
+        self.fallback = multimethod.get_method
+        # Whether what the image resolved still goes, which it does until
+        # the tables change
+        self.imaged = True
+        self.epoch = multimethod._inline_epoch
+        self.hierarchy_version = multimethod.hierarchy.__version__
+        self.methods = {}
+        self.found = multimethod._new_cache()
+        # Invalidation empties it along with the inline caches
+        multimethod._inline_caches.append(self.found)
+
+    def get_method(self, dispatch_val):
+        multimethod = self.multimethod
+        epoch = multimethod._inline_epoch
+        hierarchy_version = multimethod.hierarchy.__version__
+        if epoch != self.epoch or hierarchy_version != self.hierarchy_version:
+            if epoch != self.epoch:
+                self.imaged = False
+            self.found.clear()
+            self.epoch = epoch
+            self.hierarchy_version = hierarchy_version
+        try:
+            return self.found[dispatch_val]
+        except KeyError:
+            pass
+        except TypeError:
+            return self._resolve(dispatch_val)
+        target_func = self._resolve(dispatch_val)
+        self.found[dispatch_val] = target_func
+        # Invalidation moves the epoch on before it clears the inline caches,
+        # so if it or a change to the hierarchy got in since we looked this
+        # entry may be stale.
+        if multimethod._inline_epoch != epoch or multimethod.hierarchy.__version__ != hierarchy_version:
+            self.found.pop(dispatch_val, None)
+        return target_func
+
+    def _resolve(self, dispatch_val):
+        multimethod = self.multimethod
+        if multimethod.type_dispatch and isinstance(dispatch_val, (type, ClassType)):
+            return self.fallback(dispatch_val)
+        if self.imaged:
+            target_func = self._lookup(dispatch_val)
+            if target_func is not None:
+                return target_func
+        h = self.hierarchy
+        with multimethod.rw.read(), h.hierarchy.rw.read():
+            method_table = multimethod.method_table
+            matches = [(key, method) for key, method in method_table.iteritems() if h.is_a(dispatch_val, key)]
+            target_func = _select_best_method(multimethod.name, h, multimethod.prefer_table, dispatch_val, matches)[1]
+            if target_func is None:
+                target_func = _default_method(multimethod.name, method_table, multimethod.default_dispatch_val,
+                                              dispatch_val)
+        return target_func
+
+    def _lookup(self, dispatch_val):
+        # The method the image picks for dispatch_val, if any
+        image = self.image
+        value_id = image.value_id(dispatch_val)
+        key_id = _UNRESOLVED if value_id is None else image._id(self.section, value_id)
+        if key_id == _UNRESOLVED:
+            return None
+        target_func = self.methods.get(key_id)
+        if target_func is None:
+            multimethod = self.multimethod
+            key = multimethod.default_dispatch_val if key_id == _DEFAULT else image.value(key_id)
+            target_func = self.methods[key_id] = multimethod.method_table.get(key)
+        return target_func
+
+
+class _IdView(object):
+    # Lets bisect search the ancestor ids of a node in place
+    def __init__(self, image, start):
+        self.image = image
+        self.start = start
+
+    def __getitem__(self, i):
+        return self.image._id('ancestors', self.start + i)
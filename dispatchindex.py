@@ -0,0 +1,310 @@
+__author__ = 'wynand'
+
+# Indexes over a MultiMethod's method table, used to find the methods that
+# match a dispatch value without testing every entry of the table.
+
+from inspect import getmro
+from itertools import izip, product
+from types import ClassType
+
+MISSING = object()
+
+# Cached for dispatch values that no method matches. Their default method is
+# looked up when they are dispatched on, so that it is the current one, and
+# its absence raises NotImplementedError then as it would have on a miss.
+DEFAULT = object()
+
+_EMPTY = frozenset()
+
+
+class _Wildcard(object):
+    # The type of ANY, which in a tuple key matches any value at its position
+    def __repr__(self):
+        return 'ANY'
+
+    def __reduce__(self):
+        return 'ANY'
+
+ANY = _Wildcard()
+
+
+def compile_matcher(key):
+    # Returns a function of a hierarchy and a value that tells whether the
+    # value is_a key in the hierarchy. For tuple keys, it checks the
+    # positions of tuple values of the same length one by one, leaving out
+    # the wildcards and giving up at the first one that does not match,
+    # without building anything along the way. Strings are looked up in the
+    # ancestors of a plain Hierarchy directly.
+    if not isinstance(key, tuple):
+        return lambda hierarchy, value: hierarchy.is_a(value, key)
+    arity = len(key)
+    positions = tuple((i, component) for i, component in enumerate(key) if component is not ANY)
+
+    def matches(hierarchy, value):
+        if type(value) is not tuple:
+            return hierarchy.is_a(value, key)
+        if len(value) != arity:
+            return False
+        ancestors = hierarchy.ancestors
+        if type(ancestors) is not dict:
+            ancestors = None
+        for i, component in positions:
+            value_component = value[i]
+            if ancestors is not None and type(value_component) is str:
+                value_ancestors = ancestors.get(value_component)
+                if value_ancestors is None or component not in value_ancestors:
+                    return False
+            elif not hierarchy.is_a(value_component, component):
+                return False
+        return True
+    return matches
+
+
+class FactoredIndex(object):
+    # Indexes the tuple keys of a method table by argument position.
+    #
+    # A tuple dispatch value matches a tuple key of the same length when each
+    # of its components is_a the key's component at that position. The keys
+    # matching a dispatch value are thus the intersection, over all
+    # positions, of the keys whose component at that position matches. Those
+    # per-position matches are cached per (arity, position, component) and
+    # the winning method is cached per set of matching keys, so memory grows
+    # with the number of distinct components seen at each position instead
+    # of with the number of distinct tuples. A new combination of known
+    # components is resolved with a few set intersections.
+    #
+    # A bare ANY key matches every tuple. Other non-tuple keys are only
+    # considered for tuple dispatch values that are nodes of the hierarchy
+    # themselves; that case is left to the caller.
+    #
+    # An index describes a single version of the method table, prefer table
+    # and hierarchy, and must be discarded when any of them changes. Unless
+    # they are immutable snapshots, build it and call find_method with read
+    # locks held on the multimethod and the hierarchy. cached_method needs no
+    # locks.
+    def __init__(self, hierarchy, method_table):
+        self.hierarchy = hierarchy
+        self.method_table = method_table
+        self.order = {}
+        self.by_arity = {}
+        self.positions = {}
+        self.other_keys = []
+        for i, key in enumerate(method_table):
+            self.order[key] = i
+            if isinstance(key, tuple):
+                self.by_arity.setdefault(len(key), set()).add(key)
+                try:
+                    by_position = self.positions[len(key)]
+                except KeyError:
+                    by_position = self.positions[len(key)] = [{} for _ in key]
+                for position, component in enumerate(key):
+                    by_position[position].setdefault(component, set()).add(key)
+            else:
+                self.other_keys.append(key)
+        self.by_arity = dict((arity, frozenset(keys)) for arity, keys in self.by_arity.iteritems())
+        self.wildcard = frozenset([ANY]) if ANY in self.order else _EMPTY
+        self.component_matches = {}
+        self.methods = {}
+
+    def _matching_component_keys(self, arity, position, component):
+        cache_key = (arity, position, component)
+        try:
+            return self.component_matches[cache_key]
+        except KeyError:
+            is_a = self.hierarchy.is_a
+            keys = frozenset(key
+                             for parent, parent_keys in self.positions[arity][position].iteritems()
+                             if is_a(component, parent)
+                             for key in parent_keys)
+            self.component_matches[cache_key] = keys
+            return keys
+
+    def matching_keys(self, dispatch_val):
+        arity = len(dispatch_val)
+        keys = self.by_arity.get(arity, _EMPTY)
+        for position, component in enumerate(dispatch_val):
+            if not keys:
+                break
+            keys = keys & self._matching_component_keys(arity, position, component)
+        return keys | self.wildcard
+
+    def _matches(self, keys):
+        method_table = self.method_table
+        return ((key, method_table[key]) for key in sorted(keys, key=self.order.__getitem__))
+
+    def find_method(self, dispatch_val, select_best_method):
+        # select_best_method(dispatch_val, matches) picks the winner among the
+        # (key, method) pairs that match, as MultiMethod._select_best_method.
+        keys = self.matching_keys(dispatch_val)
+        if dispatch_val in self.hierarchy.ancestors:
+            # A tuple that is itself a node can match any other key, so
+            # this one does not get the shared treatment.
+            keys = keys.union(key for key in self.other_keys if self.hierarchy.is_a(dispatch_val, key))
+            return select_best_method(dispatch_val, self._matches(keys))[1]
+        try:
+            return self.methods[keys]
+        except KeyError:
+            target_func = select_best_method(dispatch_val, self._matches(keys))[1]
+            self.methods[keys] = target_func
+            return target_func
+
+    def forget(self, affected):
+        # Drops the cached matches of the components for which affected(component) holds
+        for cache_key in self.component_matches.keys():
+            if affected(cache_key[2]):
+                self.component_matches.pop(cache_key, None)
+
+    def cached_method(self, dispatch_val):
+        # Returns MISSING unless everything needed to answer was cached before.
+        if dispatch_val in self.hierarchy.ancestors:
+            return MISSING
+        arity = len(dispatch_val)
+        keys = self.by_arity.get(arity, _EMPTY)
+        try:
+            for position, component in enumerate(dispatch_val):
+                if not keys:
+                    break
+                keys = keys & self.component_matches[(arity, position, component)]
+            return self.methods[keys | self.wildcard]
+        except KeyError:
+            return MISSING
+
+
+def _is_sequence(value):
+    # Whether is_a would compare value to other sequences element-wise
+    if isinstance(value, (str, unicode)):
+        return False
+    return hasattr(type(value), '__iter__') or hasattr(type(value), '__getitem__')
+
+
+def _is_subclass(value, key):
+    try:
+        return issubclass(value, key)
+    except TypeError:
+        return False
+
+
+class _Candidates(object):
+    # A set of keys, or of key components at one position, that dispatch
+    # values are matched against.
+    def __init__(self, values):
+        self.members = frozenset(values)
+        self.wildcard = ANY in self.members
+        # issubclass can consider a class a subclass of these without them
+        # being in its __mro__.
+        self.checked = [value for value in self.members
+                        if isinstance(value, tuple)
+                        or (isinstance(value, (type, ClassType)) and type(value) not in (type, ClassType))]
+
+
+class AncestorIndex(object):
+    # Finds the keys of a method table that a dispatch value is_a by walking
+    # the ancestors of the value, from the hierarchy or from its __mro__ for
+    # classes outside the hierarchy, and probing the method table for each.
+    # That takes time in proportion to the depth of the hierarchy rather than
+    # to the size of the table. Tuple dispatch values are handled the same
+    # way per component, probing the method table for the combinations of
+    # the components' ancestors. Values that is_a compares element-wise to
+    # other sequences, other than tuples, get a scan of the whole table.
+    #
+    # The index only depends on the method table, and must be discarded when
+    # it changes. Call matches with read locks held on the multimethod and
+    # the hierarchy, unless both are immutable snapshots.
+    def __init__(self, method_table):
+        self.method_table = method_table
+        self.order = dict((key, i) for i, key in enumerate(method_table))
+        self.keys = _Candidates(method_table)
+        # Non-tuple sequences, i.e. strings, compare element-wise to tuples,
+        # and ANY matches them whole
+        self.sequence_keys = [key for key in method_table
+                              if not isinstance(key, tuple)
+                              and (isinstance(key, (str, unicode)) or _is_sequence(key) or key is ANY)]
+        by_arity = {}
+        for key in method_table:
+            if isinstance(key, tuple):
+                by_arity.setdefault(len(key), []).append(key)
+        self.by_arity = dict((arity, (frozenset(keys), [_Candidates(components) for components in zip(*keys)]))
+                             for arity, keys in by_arity.iteritems())
+        self.matchers = {}
+
+    def matcher(self, key):
+        # compile_matcher(key), compiled once per index
+        try:
+            return self.matchers[key]
+        except KeyError:
+            matches = self.matchers[key] = compile_matcher(key)
+            return matches
+
+    def _parents(self, hierarchy, value, candidates):
+        # Returns those of candidates that value is_a, or None if finding
+        # them takes a scan.
+        if _is_sequence(value):
+            return None
+        members = candidates.members
+        try:
+            ancestors = hierarchy.ancestors[value]
+        except KeyError:
+            if isinstance(value, (type, ClassType)):
+                mro = getmro(value)
+                parents = [cls for cls in mro if cls in members]
+                parents.extend(key for key in candidates.checked if key not in mro and _is_subclass(value, key))
+            else:
+                parents = []
+        else:
+            if len(ancestors) < len(members):
+                parents = [ancestor for ancestor in ancestors if ancestor in members]
+            else:
+                parents = [member for member in members if member in ancestors]
+        if candidates.wildcard and ANY not in parents:
+            parents.append(ANY)
+        return parents
+
+    def _tuple_keys(self, hierarchy, dispatch_val):
+        keys = [key for key in self.sequence_keys if hierarchy.is_a(dispatch_val, key)]
+        try:
+            arity_keys, positions = self.by_arity[len(dispatch_val)]
+        except KeyError:
+            return keys
+        parents = []
+        combinations = 1
+        for component, candidates in izip(dispatch_val, positions):
+            component_parents = self._parents(hierarchy, component, candidates)
+            if component_parents is None:
+                return None
+            if not component_parents:
+                return keys
+            parents.append(component_parents)
+            combinations *= len(component_parents)
+        if combinations <= len(arity_keys):
+            keys.extend(key for key in product(*parents) if key in arity_keys)
+        else:
+            parents = [frozenset(component_parents) for component_parents in parents]
+            keys.extend(key for key in arity_keys
+                        if all(component in component_parents
+                               for component, component_parents in izip(key, parents)))
+        return keys
+
+    def component_nodes(self, hierarchy, nodes):
+        # Maps the arity of every tuple key to a list per argument position
+        # of those of nodes that is_a some key component at that position.
+        return dict((arity, [[node for node in nodes if self._parents(hierarchy, node, candidates)]
+                             for candidates in positions])
+                    for arity, (keys, positions) in self.by_arity.iteritems())
+
+    def matches(self, hierarchy, dispatch_val):
+        # Returns the (key, method) pairs of the method table that
+        # dispatch_val is_a, in method table order.
+        keys = None
+        try:
+            if not isinstance(dispatch_val, tuple):
+                keys = self._parents(hierarchy, dispatch_val, self.keys)
+            elif dispatch_val not in hierarchy.ancestors:
+                keys = self._tuple_keys(hierarchy, dispatch_val)
+        except TypeError:
+            # Unhashable bits and pieces
+            pass
+        method_table = self.method_table
+        if keys is None:
+            return [(key, method) for key, method in method_table.iteritems()
+                    if self.matcher(key)(hierarchy, dispatch_val)]
+        return [(key, method_table[key]) for key in sorted(keys, key=self.order.__getitem__)]
@@ -0,0 +1,181 @@
+__author__ = 'wynand'
+
+# Declarative dispatch functions. Rather than
+#
+#     @h.multimethod(lambda w: w['type'])
+#     @h.multimethod(lambda a, b: (a['type'], b['type']))
+#
+# write
+#
+#     @h.multimethod(key('type'))
+#     @h.multimethod((key('type'), key('type')))
+#
+# A spec picks one argument of the call, by default the first one (or, in a
+# tuple of specs, the one at the same position as the spec), and takes
+#
+# * key(k): its item k, as in args[i][k];
+# * attr(name): its attribute name, which may be dotted, as in args[i].name;
+# * type_of(): its type;
+# * arg(): the argument itself.
+#
+# A tuple of specs makes a tuple dispatch value. compile_spec turns a spec into a
+# dispatch function. Given the names of the parameters, as MultiMethod takes
+# them from its default method, that is a generated function with the same
+# parameters, which calls may pass by keyword too. Given only the number of
+# arguments calls pass, positionally, a single spec becomes the
+# operator.itemgetter, operator.attrgetter or type that does the job, so no
+# Python frame is involved in dispatching, and anything else a generated
+# function. Without either, the generated function takes *args and **kwargs
+# as well. MultiMethod still takes the builtin for calls that pass their
+# arguments positionally, and MultiMethod.specialize goes one further and
+# generates the accessors right into the function it returns.
+
+from inspect import getargspec
+from operator import attrgetter, itemgetter
+import re
+
+_ATTRIBUTE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
+
+class Spec(object):
+    def __init__(self, kind, name=None, arg=None):
+        if arg is not None and (not isinstance(arg, (int, long)) or arg < 0):
+            raise ValueError("Argument positions are counted from 0, not {0!r}".format(arg))
+        self.kind = kind
+        self.name = name
+        self.arg = arg
+
+    def __repr__(self):
+        args = [] if self.name is None else [repr(self.name)]
+        if self.arg is not None:
+            args.append('arg={0}'.format(self.arg))
+        return '{0}({1})'.format(self.kind, ', '.join(args))
+
+    def getter(self):
+        # A builtin that does the job on a single argument, or None
+        if self.kind == 'key':
+            return itemgetter(self.name)
+        if self.kind == 'attr':
+            return attrgetter(self.name)
+        if self.kind == 'type_of':
+            return type
+        return None
+
+    def expression(self, param, namespace):
+        # Source for what the spec takes from the argument spelled param,
+        # adding whatever that refers to to namespace
+        if self.kind == 'key':
+            if type(self.name) in (str, unicode, int, long):
+                # A literal, which costs less to load than a global
+                return '{0}[{1!r}]'.format(param, self.name)
+            constant = '_key{0}'.format(len(namespace))
+            namespace[constant] = self.name
+            return '{0}[{1}]'.format(param, constant)
+        if self.kind == 'attr':
+            return '{0}.{1}'.format(param, self.name)
+        if self.kind == 'type_of':
+            namespace['_type'] = type
+            return '_type({0})'.format(param)
+        return param
+
+
+def key(k, arg=None):
+    return Spec('key', k, arg)
+
+
+def attr(name, arg=None):
+    if not isinstance(name, str) or not _ATTRIBUTE.match(name):
+        raise ValueError("Not an attribute name: {0!r}".format(name))
+    return Spec('attr', name, arg)
+
+
+def type_of(arg=None):
+    return Spec('type_of', None, arg)
+
+
+def arg(position=None):
+    return Spec('arg', None, position)
+
+
+def is_spec(value):
+    return isinstance(value, Spec) or (isinstance(value, tuple) and value != ()
+                                       and all(isinstance(spec, Spec) for spec in value))
+
+
+def _positions(spec):
+    # The specs of a spec and the argument positions they take from
+    if isinstance(spec, Spec):
+        return [(spec, 0 if spec.arg is None else spec.arg)]
+    return [(s, i if s.arg is None else s.arg) for i, s in enumerate(spec)]
+
+
+def expression(spec, params, namespace):
+    # Source for the dispatch value spec takes from the arguments spelled
+    # params, adding whatever that refers to to namespace
+    parts = []
+    for s, position in _positions(spec):
+        if position >= len(params):
+            raise ValueError("Dispatch spec {0!r} needs more than {1} arguments".format(spec, len(params)))
+        parts.append(s.expression(params[position], namespace))
+    if isinstance(spec, Spec):
+        return parts[0]
+    return '({0},)'.format(', '.join(parts))
+
+
+def needed_arity(spec):
+    # The number of positional arguments spec takes from
+    return max(position for _, position in _positions(spec)) + 1
+
+
+def getter(spec):
+    # A builtin that takes the dispatch value from the first argument, for
+    # a single spec on that, or None
+    if isinstance(spec, Spec) and _positions(spec)[0][1] == 0:
+        return spec.getter()
+    return None
+
+
+def fixed_parameters(func):
+    # The names of the parameters func takes, if their number is fixed, else None
+    try:
+        args, varargs, keywords, defaults = getargspec(func)
+    except TypeError:
+        return None
+    if varargs is not None or keywords is not None or defaults:
+        return None
+    # Less self, for bound methods
+    if getattr(func, '__self__', None) is not None:
+        args = args[1:]
+    return args
+
+
+def fixed_arity(func):
+    # The number of arguments func takes, if that is fixed, else None
+    params = fixed_parameters(func)
+    return None if params is None else len(params)
+
+
+def compile_spec(spec, arity=None, names=None):
+    # Returns the dispatch function for spec, for calls that pass arity
+    # positional arguments and nothing else, for calls to parameters named
+    # names, or for any calls if neither is given
+    if names is not None and not all(isinstance(name, str) and not name.startswith('_') for name in names):
+        # Unpacked tuples, or names that could clash with those in the
+        # namespace; calls will have to pass them positionally
+        arity, names = len(names), None
+    if names is not None:
+        params = list(names)
+        signature = ', '.join(params)
+    elif arity is None:
+        params = ['a{0}'.format(i) for i in xrange(needed_arity(spec))]
+        signature = ', '.join(params + ['*args', '**kwargs'])
+    else:
+        builtin = getter(spec)
+        if arity == 1 and builtin is not None:
+            return builtin
+        params = ['a{0}'.format(i) for i in xrange(arity)]
+        signature = ', '.join(params)
+    namespace = {}
+    source = 'def dispatch({0}):\n    return {1}\n'.format(signature, expression(spec, params, namespace))
+    exec compile(source, '<dispatch spec {0!r}>'.format(spec), 'exec') in namespace
+    return namespace['dispatch']
@@ -26,9 +26,27 @@
 
 __author__ = 'wynand'
 
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import chain, izip
+from types import ClassType
+import csv
+import gc
+import json
+
+import asyncmultimethod
+import dispatchindex
+import metrics
 import rwlock
 import multimethod
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class ParentAlreadyInHierarchy(Exception):
     pass
@@ -38,14 +56,82 @@ class CircularRelationship(Exception):
     pass
 
 
+class HierarchyFrozen(Exception):
+    pass
+
+
 class Hierarchy(object):
-    def __init__(self):
+    def __init__(self, copy_on_write=False, lock=None):
         self.__version__ = 0
-        self.rw = rwlock.ReadWriteLock()
+        # Any of the locks in rwlock will do; see there for their trade-offs
+        self.rw = lock if lock is not None else rwlock.ReadWriteLock()
         self.parents = {}
         self.ancestors = {}
         self.children = {}
 
+        # (version, nodes) for the latest versions, where nodes are those whose
+        # ancestors changed in that version. Lets multimethods evict only the
+        # cache entries that a change can affect.
+        self.changes = deque(maxlen=256)
+
+        # In copy on write mode, every change publishes an immutable copy of
+        # the hierarchy as snapshot, which can be used without locking.
+        self.copy_on_write = copy_on_write
+        self.snapshot = self._copy() if copy_on_write else None
+
+        # Set for good by freeze, after which derive raises HierarchyFrozen
+        self.frozen = False
+
+        # The edges derived so far in a batch, if one is under way
+        self._batch = None
+
+        # A metrics.Metrics while enable_metrics is in effect
+        self.metrics = None
+
+    def _copy(self):
+        # You must hold at least a read lock to call this
+        copy = type(self)()
+        copy.__version__ = self.__version__
+        self._copy_relations(copy)
+        copy.changes = deque(self.changes, self.changes.maxlen)
+        return copy
+
+    # Apart from node lookups in parents, the relations between nodes are only
+    # ever accessed through the following methods, so that subclasses can
+    # store them differently.
+
+    def _copy_relations(self, copy):
+        copy.parents = dict((node, set(nodes)) for node, nodes in self.parents.iteritems())
+        copy.children = dict((node, set(nodes)) for node, nodes in self.children.iteritems())
+        copy.ancestors = dict((node, set(nodes)) for node, nodes in self.ancestors.iteritems())
+
+    def _link(self, child, parent):
+        self.children[parent].add(child)
+        self.parents[child].add(parent)
+
+    def _link_many(self, new_parents, new_children):
+        # Links several edges at once; new_parents and new_children map nodes
+        # to lists of their new parents and children respectively.
+        for child, parents in new_parents.iteritems():
+            self.parents[child].update(parents)
+        for parent, children in new_children.iteritems():
+            self.children[parent].update(children)
+
+    def _has_ancestor(self, node, ancestor):
+        # Raises KeyError if node is not in the hierarchy
+        return ancestor in self.ancestors[node]
+
+    def _has_any_ancestor(self, node, ancestors):
+        # Raises KeyError if node is not in the hierarchy
+        return not ancestors.isdisjoint(self.ancestors[node])
+
+    def _inherit_ancestors(self, node, parent):
+        self.ancestors[node] |= self.ancestors[parent]
+
+    def _inherit_all_ancestors(self, node, parents):
+        for parent in parents:
+            self._inherit_ancestors(node, parent)
+
     def _add_node(self, node):
         if node not in self.parents:
             self.parents[node] = set()
@@ -53,27 +139,30 @@ class Hierarchy(object):
             self.children[node] = set()
 
     def _add_edge(self, child, parent):
+        # A node that is new to the hierarchy becomes is_a itself, so that
+        # counts as a change too.
+        changed = (child,) if parent in self.parents else (child, parent)
         self._add_node(parent)
         self._add_node(child)
 
-        self.children[parent].add(child)
-        self.parents[child].add(parent)
-        self.ancestors[child] |= self.ancestors[parent]
+        self._link(child, parent)
+        self._inherit_ancestors(child, parent)
         self._add_ancestor_to_descendants(child, parent)
 
         self.__version__ += 1
+        self.changes.append((self.__version__, changed))
+        if self.metrics is not None:
+            self.metrics.record_invalidation('derive', len(changed))
 
     def _add_ancestor_to_descendants(self, child, parent):
-        seen = set()
-
-        def loop(node):
-            for child in self.children[node]:
-                if child not in seen:
-                    seen.add(node)
-                    self.ancestors[child].add(parent)
-                    loop(child)
-
-        loop(child)
+        seen = {child}
+        stack = [child]
+        while stack:
+            for descendant in self.children[stack.pop()]:
+                if descendant not in seen:
+                    seen.add(descendant)
+                    self._inherit_ancestors(descendant, parent)
+                    stack.append(descendant)
 
     def _derive_dict(self, children, parent):
         if children is not None:
@@ -90,31 +179,239 @@ class Hierarchy(object):
             # relationship, just return, as nothing has changed.
             if parent in self.parents[child]:
                 return
-            if child in self.ancestors[parent]:
+            if self._has_ancestor(parent, child):
                 raise CircularRelationship()
-            if parent in self.ancestors[child]:
+            if self._has_ancestor(child, parent):
                 raise ParentAlreadyInHierarchy()
-        self._add_edge(child, parent)
+        if self._batch is not None:
+            self._batch[(child, parent)] = None
+        else:
+            self._add_edge(child, parent)
+
+    def _add_edges(self, edges):
+        # You must hold a write lock to call this. Links all of edges and
+        # brings the ancestors of everything below them up to date in one
+        # topological pass, as a single version. Raises CircularRelationship,
+        # without changing anything, if that would close a cycle.
+        new_parents = {}
+        new_children = {}
+        for child, parent in edges:
+            new_parents.setdefault(child, []).append(parent)
+            new_children.setdefault(parent, []).append(child)
+
+        # Only the ancestors of the new children and their descendants
+        # change. Gather those along with their children, old and new.
+        below = {}
+        stack = list(new_parents)
+        while stack:
+            node = stack.pop()
+            if node not in below:
+                node_children = below[node] = list(chain(self.children.get(node, ()), new_children.get(node, ())))
+                stack.extend(node_children)
+
+        # Kahn's algorithm; whatever it cannot order is on a cycle
+        parent_counts = dict.fromkeys(below, 0)
+        for node_children in below.itervalues():
+            for child in node_children:
+                parent_counts[child] += 1
+        order = [node for node, count in parent_counts.iteritems() if not count]
+        for node in order:
+            for child in below[node]:
+                count = parent_counts[child] = parent_counts[child] - 1
+                if not count:
+                    order.append(child)
+        if len(order) < len(below):
+            raise CircularRelationship()
+
+        changed = set(new_parents)
+        changed.update(node for node in new_children if node not in self.parents)
+        for node in changed:
+            self._add_node(node)
+        self._link_many(new_parents, new_children)
+        for node in order:
+            # Only affected parents and new ones have anything new to pass on
+            parents = [parent for parent in self.parents[node] if parent in below]
+            parents.extend(parent for parent in new_parents.get(node, ()) if parent not in below)
+            if parents:
+                self._inherit_all_ancestors(node, parents)
+        self.__version__ += 1
+        self.changes.append((self.__version__, frozenset(changed)))
+        if self.metrics is not None:
+            self.metrics.record_invalidation('batch', len(changed))
 
     def derive(self, child, parent=None):
         with self.rw.write():
-            if parent is None and isinstance(child, dict):
-                for parent, children in child.viewitems():
-                    self._derive_dict(children, parent)
+            if self.frozen:
+                raise HierarchyFrozen("Cannot derive {0} from {1} in a frozen hierarchy".format(child, parent))
+            try:
+                if parent is None and isinstance(child, dict):
+                    for parent, children in child.viewitems():
+                        self._derive_dict(children, parent)
+                else:
+                    self._derive(child, parent)
+            finally:
+                # Publish whatever made it in, even if a later edge failed.
+                if self.copy_on_write and self.snapshot.__version__ != self.__version__:
+                    self.snapshot = self._copy()
+
+    @classmethod
+    def from_edges(cls, edges, copy_on_write=False, lock=None):
+        # Builds a hierarchy from an iterable of (child, parent) pairs in one
+        # topological pass, which is much faster than deriving them one at a
+        # time. Repeated pairs are fine; redundant ones (where the parent is
+        # already an ancestor of the child by another route) are not checked
+        # for. Raises CircularRelationship if the pairs contain a cycle.
+        h = cls(copy_on_write, lock)
+        # The collector only slows the building of millions of containers down
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            seen = set()
+            unique_edges = []
+            for child, parent in edges:
+                edge = (child, parent)
+                if edge not in seen:
+                    seen.add(edge)
+                    unique_edges.append(edge)
+            del seen
+            if unique_edges:
+                with h.rw.write():
+                    h._add_edges(unique_edges)
+                    if copy_on_write:
+                        h.snapshot = h._copy()
+        finally:
+            if collecting:
+                gc.enable()
+        return h
+
+    @classmethod
+    def load(cls, path, format=None, copy_on_write=False, lock=None):
+        # Reads (child, parent) pairs from a file and builds a hierarchy from
+        # them with from_edges. The format is 'csv', two columns per row, or
+        # 'json', a JSON list [child, parent] or object {"child": ...,
+        # "parent": ...} per line. By default it follows from the file's
+        # extension (.csv, or .json/.jsonl).
+        if format is None:
+            format = 'csv' if path.lower().endswith('.csv') else 'json'
+        if format not in ('csv', 'json'):
+            raise ValueError("Unknown edge file format: {0}".format(format))
+        with open(path, 'rb') as f:
+            if format == 'csv':
+                edges = (row[:2] for row in csv.reader(f) if row)
             else:
-                self._derive(child, parent)
+                edges = (_json_edge(json.loads(line)) for line in f if line.strip())
+            return cls.from_edges(edges, copy_on_write, lock)
+
+    @contextmanager
+    def batch(self):
+        # Collects the derives in the with block and applies them in one go
+        # when it exits, under a single write lock and as a single version,
+        # so that multimethods only have to catch up once. Cycles are checked
+        # for then, and if there is one, or the block raises, none of the
+        # derives take effect. Until then the hierarchy looks unchanged, even
+        # to the thread doing the deriving.
+        with self.rw.write():
+            if self._batch is not None:
+                # Part of an enclosing batch
+                yield self
+                return
+            if self.frozen:
+                raise HierarchyFrozen("Cannot change a frozen hierarchy")
+            self._batch = OrderedDict()
+            try:
+                yield self
+                edges = self._batch.keys()
+            finally:
+                self._batch = None
+            if edges:
+                self._add_edges(edges)
+                if self.copy_on_write:
+                    self.snapshot = self._copy()
+
+    def enable_metrics(self, on_event=None):
+        # Starts timing the lock and counting changes, per cause along with
+        # the number of nodes whose ancestors changed, and returns the
+        # metrics.Metrics that records it. Nodes stand in for cache entries.
+        with self.rw.write():
+            if self.metrics is None:
+                recorder = self.metrics = metrics.Metrics(on_event)
+                recorder.size = lambda: len(self.parents)
+                self.rw = metrics.InstrumentedLock(self.rw, recorder)
+            return self.metrics
+
+    def disable_metrics(self):
+        with self.rw.write():
+            if self.metrics is not None:
+                self.metrics = None
+                self.rw = self.rw.lock
+
+    def freeze(self):
+        # Rules out further changes, which is what lets multimethods seal
+        # themselves against the hierarchy (see MultiMethod.seal).
+        with self.rw.write():
+            self.frozen = True
+        return self
+
+    def changed_since(self, version):
+        # At least a read-lock must be held before calling this. Returns the set
+        # of nodes whose ancestors changed after version (their descendants
+        # aside), or None if the change log does not go back that far.
+        if version == self.__version__:
+            return set()
+        if not self.changes or self.changes[0][0] > version + 1:
+            return None
+        changed = set()
+        for change_version, nodes in self.changes:
+            if change_version > version:
+                changed.update(nodes)
+        return changed
+
+    def depends_on(self, value, nodes):
+        # At least a read-lock must be held before calling this. Tells whether
+        # value, or a component of a tuple value, descends from one of nodes,
+        # i.e. whether is_a may have changed its mind about value when the
+        # ancestors of nodes changed.
+        try:
+            if self._has_any_ancestor(value, nodes):
+                return True
+        except (KeyError, TypeError):
+            pass
+        if isinstance(value, tuple):
+            return any(self.depends_on(component, nodes) for component in value)
+        return False
 
     def is_a(self, child, parent):
         # At least a read-lock must be held before calling this
 
+        if parent is dispatchindex.ANY:
+            return True
         # We treat strings specially, since otherwise they are
         # treated as sequences, which is probably not what most
         # people want.
         if isinstance(child, (str, unicode)):
             try:
-                return parent in self.ancestors[child]
+                return self._has_ancestor(child, parent)
             except KeyError:
                 return False
+        # Classes with a plain metaclass cannot be sequences, which spares
+        # us the failed attempt at treating them as such below.
+        if type(child) is type or type(child) is ClassType:
+            if child in self.ancestors:
+                return self._has_ancestor(child, parent)
+            if not isinstance(parent, (type, ClassType, tuple)):
+                return False
+            try:
+                return issubclass(child, parent)
+            except TypeError:
+                return False
+        # Tuples are the sequences we see most, so they get a shortcut
+        if type(child) is tuple and type(parent) is tuple:
+            if len(child) != len(parent):
+                return False
+            for child_component, parent_component in izip(child, parent):
+                if not self.is_a(child_component, parent_component):
+                    return False
+            return True
         # First, let's see whether we're dealing with sequences...
         try:
             child_seq = list(child)
@@ -128,7 +425,7 @@ class Hierarchy(object):
             # Okay, so we're not dealing with strings or sequences.
             try:
                 # Do we already have a relationship between parent and child?
-                return parent in self.ancestors[child]
+                return self._has_ancestor(child, parent)
             except KeyError:
                 # There is no relationship between parent.
                 try:
@@ -140,7 +437,181 @@ class Hierarchy(object):
                     pass
         return False
 
-    def multimethod(self, dispatch_func=lambda x: x, default_dispatch_val=multimethod.DefaultDispatchValue):
+    def is_a_many(self, children, parents):
+        # At least a read-lock must be held before calling this. Returns a numpy
+        # array of booleans telling whether each child is_a the parent at the
+        # same position in parents.
+        if numpy is None:
+            raise ImportError("is_a_many needs numpy")
+        children, parents = list(children), list(parents)
+        if len(children) != len(parents):
+            raise ValueError("is_a_many needs as many parents as children")
+        return numpy.fromiter((self.is_a(child, parent) for child, parent in izip(children, parents)),
+                              dtype=bool, count=len(children))
+
+    def async_multimethod(self, dispatch_func=lambda x: x, default_dispatch_val=multimethod.DefaultDispatchValue,
+                          cache=None, factored=False, copy_on_write=None, executor=None, lock=None):
+        # Like multimethod below, for use with trollius; see asyncmultimethod
+        def decorator(func):
+            return asyncmultimethod.AsyncMultiMethod(func.__name__, dispatch_func, default_dispatch_val, self,
+                                                     default_func=func, cache=cache, factored=factored,
+                                                     copy_on_write=copy_on_write, executor=executor, lock=lock)
+        return decorator
+
+    def multimethod(self, dispatch_func=lambda x: x, default_dispatch_val=multimethod.DefaultDispatchValue, cache=None,
+                    factored=False, copy_on_write=None, type_dispatch=False, lock=None):
         def decorator(func):
-            return multimethod.MultiMethod(func.__name__, dispatch_func, default_dispatch_val, self, default_func=func)
+            return multimethod.MultiMethod(func.__name__, dispatch_func, default_dispatch_val, self, default_func=func,
+                                           cache=cache, factored=factored, copy_on_write=copy_on_write,
+                                           type_dispatch=type_dispatch, lock=lock)
         return decorator
+
+
+def _json_edge(edge):
+    if isinstance(edge, dict):
+        return edge['child'], edge['parent']
+    child, parent = edge
+    return child, parent
+
+
+class _AncestorView(object):
+    # Read-only stand-in for Hierarchy.ancestors in a CompactHierarchy
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+
+    def __contains__(self, node):
+        return node in self.hierarchy.ids
+
+    def __getitem__(self, node):
+        h = self.hierarchy
+        return frozenset(h.nodes[i] for i in h.ancestor_ids[h.ids[node]])
+
+    def get(self, node, default=None):
+        try:
+            return self[node]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.hierarchy.nodes)
+
+    def __len__(self):
+        return len(self.hierarchy.nodes)
+
+    def iteritems(self):
+        for node in self.hierarchy.nodes:
+            yield node, self[node]
+
+
+class CompactHierarchy(Hierarchy):
+    # A Hierarchy for large taxonomies. The transitive closure in ancestors is
+    # what makes a Hierarchy big, so here nodes are interned to integer ids
+    # and the ancestors of each node are kept as a sorted array of ids, which
+    # takes a fraction of the memory of a set of nodes. is_a then becomes a
+    # binary search in such an array.
+    #
+    # Parents and children are kept as tuples rather than sets, and ancestors
+    # is a read-only view that builds sets on demand; prefer is_a and
+    # is_a_many.
+    def __init__(self, copy_on_write=False, lock=None):
+        self.ids = {}
+        self.nodes = []
+        self.ancestor_ids = []
+        self._sequence_nodes = False
+        super(CompactHierarchy, self).__init__(copy_on_write, lock)
+        self.ancestors = _AncestorView(self)
+
+    def _copy_relations(self, copy):
+        copy.parents = dict(self.parents)
+        copy.children = dict(self.children)
+        copy.ids = dict(self.ids)
+        copy.nodes = list(self.nodes)
+        copy.ancestor_ids = [array('i', ids) for ids in self.ancestor_ids]
+        copy._sequence_nodes = self._sequence_nodes
+
+    def _link(self, child, parent):
+        self.children[parent] += (child,)
+        self.parents[child] += (parent,)
+
+    def _link_many(self, new_parents, new_children):
+        for child, parents in new_parents.iteritems():
+            self.parents[child] += tuple(parents)
+        for parent, children in new_children.iteritems():
+            self.children[parent] += tuple(children)
+
+    def _add_node(self, node):
+        if node not in self.parents:
+            self.parents[node] = ()
+            self.children[node] = ()
+            self.ids[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.ancestor_ids.append(array('i', [self.ids[node]]))
+            if not isinstance(node, (str, unicode)) and hasattr(node, '__iter__'):
+                self._sequence_nodes = True
+
+    def _has_ancestor(self, node, ancestor):
+        ancestor_ids = self.ancestor_ids[self.ids[node]]
+        try:
+            ancestor_id = self.ids[ancestor]
+        except KeyError:
+            return False
+        i = bisect_left(ancestor_ids, ancestor_id)
+        return i < len(ancestor_ids) and ancestor_ids[i] == ancestor_id
+
+    def _has_any_ancestor(self, node, ancestors):
+        return any(self._has_ancestor(node, ancestor) for ancestor in ancestors)
+
+    def _inherit_ancestors(self, node, parent):
+        node_id = self.ids[node]
+        ids = set(self.ancestor_ids[node_id])
+        ids.update(self.ancestor_ids[self.ids[parent]])
+        self.ancestor_ids[node_id] = array('i', sorted(ids))
+
+    def _inherit_all_ancestors(self, node, parents):
+        node_id = self.ids[node]
+        ids = set(self.ancestor_ids[node_id])
+        for parent in parents:
+            ids.update(self.ancestor_ids[self.ids[parent]])
+        self.ancestor_ids[node_id] = array('i', sorted(ids))
+
+    def _ancestor_pairs(self, node_ids):
+        # Sorted i * len(nodes) + ancestor_id for the ancestors of every
+        # node_ids[i], which must be sorted, so that is_a_many can look up
+        # all its pairs at once. Built per call, from the ancestor arrays of
+        # just those nodes, which numpy reads in place.
+        ancestor_ids = [numpy.frombuffer(self.ancestor_ids[node_id], dtype=numpy.int32) for node_id in node_ids]
+        lengths = [len(ids) for ids in ancestor_ids]
+        return (numpy.repeat(numpy.arange(len(node_ids), dtype=numpy.int64) * len(self.nodes), lengths) +
+                numpy.concatenate(ancestor_ids))
+
+    def is_a_many(self, children, parents):
+        # At least a read-lock must be held before calling this
+        if numpy is None:
+            raise ImportError("is_a_many needs numpy")
+        children, parents = list(children), list(parents)
+        if len(children) != len(parents):
+            raise ValueError("is_a_many needs as many parents as children")
+        ids = self.ids
+        try:
+            child_ids = numpy.array([ids.get(child, -1) for child in children], dtype=numpy.int64)
+            parent_ids = numpy.array([ids.get(parent, -1) for parent in parents], dtype=numpy.int64)
+        except TypeError:
+            child_ids = None
+        if child_ids is None or self._sequence_nodes:
+            # Unhashable values, or nodes that is_a treats as sequences
+            return super(CompactHierarchy, self).is_a_many(children, parents)
+
+        result = numpy.zeros(len(children), dtype=bool)
+        # Children outside the hierarchy may be sequences or classes, and
+        # get is_a's full treatment, as does ANY, which is not a node
+        any_parents = numpy.array([parent is dispatchindex.ANY for parent in parents], dtype=bool)
+        for i in numpy.flatnonzero((child_ids < 0) | any_parents):
+            result[i] = self.is_a(children[i], parents[i])
+        known = numpy.flatnonzero((child_ids >= 0) & (parent_ids >= 0))
+        if len(known):
+            known_children, indexes = numpy.unique(child_ids[known], return_inverse=True)
+            codes = self._ancestor_pairs(known_children)
+            queries = indexes * len(self.nodes) + parent_ids[known]
+            found = numpy.searchsorted(codes, queries).clip(0, len(codes) - 1)
+            result[known] = codes[found] == queries
+        return result
@@ -0,0 +1,322 @@
+__author__ = 'wynand'
+
+# Bounded replacements for the plain dict used as MultiMethod.method_cache.
+#
+# They implement the small part of the dict protocol that MultiMethod relies
+# on (get, item assignment and deletion, clear, len, keys), so any of them
+# can be passed to MultiMethod (or Hierarchy.multimethod) through the cache
+# argument. get() is O(1) for every policy. Reads happen without the
+# multimethod lock held, while get() updates recency/frequency bookkeeping,
+# so each cache protects its own state with a plain mutex.
+#
+# Every entry thrown out to make room bumps the evictions counter and is
+# passed to the optional on_evict(key, value) callback. Entries dropped by
+# clear() (i.e. cache resets) are not evictions.
+
+from collections import OrderedDict
+from threading import Lock
+
+_missing = object()
+
+
+class MethodCache(object):
+    def __init__(self, maxsize=1024, on_evict=None):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1, not {0}".format(maxsize))
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._lock = Lock()
+
+    def _report(self, evicted):
+        # Call this without holding self._lock, on_evict may well want to
+        # look at the cache.
+        self.evictions += len(evicted)
+        if self.on_evict is not None:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def fresh(self):
+        # An empty cache with the same policy and settings, but no history.
+        return type(self)(self.maxsize, self.on_evict)
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            evicted = self._put(key, value)
+        if evicted:
+            self._report(evicted)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def pop(self, key, default=_missing):
+        try:
+            value = self[key]
+            del self[key]
+            return value
+        except KeyError:
+            if default is _missing:
+                raise
+            return default
+
+    def __repr__(self):
+        return '{0}(maxsize={1}, size={2}, evictions={3})'.format(
+            type(self).__name__, self.maxsize, len(self), self.evictions)
+
+
+class LRUCache(MethodCache):
+    # Least recently used entries go first. The recency order is kept in a
+    # circular doubly linked list of [prev, next, key, value] links, so that
+    # a hit only has to relink one entry.
+
+    def __init__(self, maxsize=1024, on_evict=None):
+        super(LRUCache, self).__init__(maxsize, on_evict)
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    @staticmethod
+    def _unlink(link):
+        prev_link, next_link = link[0], link[1]
+        prev_link[1] = next_link
+        next_link[0] = prev_link
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def _put(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._append(link)
+            return ()
+        evicted = []
+        if len(self._links) >= self.maxsize:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._links[oldest[2]]
+            evicted.append((oldest[2], oldest[3]))
+        link = [None, None, key, value]
+        self._append(link)
+        self._links[key] = link
+        return evicted
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._unlink(self._links.pop(key))
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+    def keys(self):
+        return self._links.keys()
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+            self._root[:] = [self._root, self._root, None, None]
+
+
+class LFUCache(MethodCache):
+    # Least frequently used entries go first; ties are broken by recency.
+    # Entries live in one bucket per use count and we track the lowest
+    # populated count, which keeps both hits and evictions O(1).
+    def __init__(self, maxsize=1024, on_evict=None):
+        super(LFUCache, self).__init__(maxsize, on_evict)
+        self._entries = {}
+        self._buckets = {}
+        self._min_count = 0
+
+    def _touch(self, key, entry):
+        count = entry[1]
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+        entry[1] = count + 1
+        try:
+            self._buckets[count + 1][key] = None
+        except KeyError:
+            self._buckets[count + 1] = OrderedDict([(key, None)])
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._touch(key, entry)
+            return entry[0]
+
+    def _put(self, key, value):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[0] = value
+            self._touch(key, entry)
+            return ()
+        evicted = []
+        if len(self._entries) >= self.maxsize:
+            bucket = self._buckets[self._min_count]
+            old_key = bucket.popitem(last=False)[0]
+            if not bucket:
+                del self._buckets[self._min_count]
+            evicted.append((old_key, self._entries.pop(old_key)[0]))
+        self._entries[key] = [value, 1]
+        try:
+            self._buckets[1][key] = None
+        except KeyError:
+            self._buckets[1] = OrderedDict([(key, None)])
+        self._min_count = 1
+        return evicted
+
+    def __delitem__(self, key):
+        with self._lock:
+            count = self._entries.pop(key)[1]
+            bucket = self._buckets[count]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[count]
+                if self._min_count == count:
+                    self._min_count = min(self._buckets) if self._buckets else 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._min_count = 0
+
+
+class ARCCache(MethodCache):
+    # Adaptive replacement cache (Megiddo & Modha). t1 holds entries seen
+    # once recently, t2 entries seen at least twice. b1 and b2 remember the
+    # keys recently evicted from t1 and t2, and hits on those ghosts shift
+    # the target size p of t1, so the cache adapts between recency and
+    # frequency depending on the workload.
+    def __init__(self, maxsize=1024, on_evict=None):
+        super(ARCCache, self).__init__(maxsize, on_evict)
+        self._t1 = OrderedDict()
+        self._t2 = OrderedDict()
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+        self._p = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._t1:
+                value = self._t2[key] = self._t1.pop(key)
+                return value
+            if key in self._t2:
+                value = self._t2[key] = self._t2.pop(key)
+                return value
+            return default
+
+    def _replace(self, in_b2, evicted):
+        t1_size = len(self._t1)
+        if t1_size + len(self._t2) < self.maxsize:
+            # Only possible after explicit deletions; there is room already.
+            return
+        if t1_size and (t1_size > self._p or (in_b2 and t1_size == self._p) or not self._t2):
+            old_key, old_value = self._t1.popitem(last=False)
+            self._b1[old_key] = None
+        else:
+            old_key, old_value = self._t2.popitem(last=False)
+            self._b2[old_key] = None
+        evicted.append((old_key, old_value))
+
+    def _put(self, key, value):
+        t1, t2, b1, b2 = self._t1, self._t2, self._b1, self._b2
+        c = self.maxsize
+        if key in t1:
+            del t1[key]
+            t2[key] = value
+            return ()
+        if key in t2:
+            del t2[key]
+            t2[key] = value
+            return ()
+        evicted = []
+        if key in b1:
+            self._p = min(c, self._p + max(len(b2) // len(b1), 1))
+            self._replace(False, evicted)
+            del b1[key]
+            t2[key] = value
+            return evicted
+        if key in b2:
+            self._p = max(0, self._p - max(len(b1) // len(b2), 1))
+            self._replace(True, evicted)
+            del b2[key]
+            t2[key] = value
+            return evicted
+        l1 = len(t1) + len(b1)
+        if l1 == c:
+            if len(t1) < c:
+                b1.popitem(last=False)
+                self._replace(False, evicted)
+            else:
+                old_key, old_value = t1.popitem(last=False)
+                evicted.append((old_key, old_value))
+        else:
+            total = l1 + len(t2) + len(b2)
+            if total >= c:
+                if total == 2 * c:
+                    b2.popitem(last=False)
+                self._replace(False, evicted)
+        t1[key] = value
+        return evicted
+
+    def __delitem__(self, key):
+        with self._lock:
+            try:
+                del self._t1[key]
+            except KeyError:
+                del self._t2[key]
+
+    def __contains__(self, key):
+        return key in self._t1 or key in self._t2
+
+    def __len__(self):
+        return len(self._t1) + len(self._t2)
+
+    def keys(self):
+        return self._t1.keys() + self._t2.keys()
+
+    def clear(self):
+        with self._lock:
+            self._t1.clear()
+            self._t2.clear()
+            self._b1.clear()
+            self._b2.clear()
+            self._p = 0
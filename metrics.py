@@ -0,0 +1,159 @@
+__author__ = 'wynand'
+
+# Opt-in instrumentation for multimethods and hierarchies, switched on with
+# their enable_metrics methods and off again with disable_metrics.
+#
+# Nothing on the dispatch path checks whether metrics are wanted. Enabling
+# them swaps instrumented stand-ins in for the methods and locks concerned
+# instead, the same way copy on write and sealed multimethods swap in their
+# own get_method, so that a multimethod without metrics runs exactly the code
+# it ran before. Only the paths that change things (cache invalidation and
+# hierarchy changes) look at the metrics attribute, and those are slow anyway.
+#
+# A Metrics object can be read at any time with snapshot(), and passes every
+# miss, invalidation and lock use on to its on_event(name, value) callback as
+# it happens, if it has one. Calls are only counted, not reported one by one.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, float('inf'))
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'buckets': zip(BUCKETS, self.counts)}
+
+
+class Metrics(object):
+    # What a multimethod or hierarchy did since the metrics were enabled or
+    # last reset. A dispatch that had to resolve the dispatch value counts as
+    # a miss, any other as a hit. Invalidations are counted per cause, along
+    # with the number of cache entries (or, for a hierarchy, nodes) involved.
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        # Set by the owner to something returning the size of its cache
+        self.size = None
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.misses = 0
+            self.resolution = Histogram()
+            self.invalidations = {}
+            self.lock_wait = {'read': Histogram(), 'write': Histogram()}
+            self.lock_hold = {'read': Histogram(), 'write': Histogram()}
+
+    def _emit(self, name, value):
+        if self.on_event is not None:
+            self.on_event(name, value)
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def record_miss(self, seconds):
+        with self._lock:
+            self.misses += 1
+            self.resolution.add(seconds)
+        self._emit('miss', seconds)
+
+    def record_invalidation(self, cause, entries):
+        with self._lock:
+            counts = self.invalidations.setdefault(cause, {'count': 0, 'entries': 0})
+            counts['count'] += 1
+            counts['entries'] += entries
+        self._emit('invalidation', (cause, entries))
+
+    def record_lock(self, mode, waited, held):
+        with self._lock:
+            self.lock_wait[mode].add(waited)
+            self.lock_hold[mode].add(held)
+        self._emit('lock_' + mode, (waited, held))
+
+    def snapshot(self):
+        with self._lock:
+            hits = max(self.calls - self.misses, 0)
+            return {'calls': self.calls,
+                    'hits': hits,
+                    'misses': self.misses,
+                    'hit_ratio': float(hits) / self.calls if self.calls else None,
+                    'resolution': self.resolution.as_dict(),
+                    'invalidations': dict((cause, dict(counts)) for cause, counts in self.invalidations.iteritems()),
+                    'lock_wait': dict((mode, h.as_dict()) for mode, h in self.lock_wait.iteritems()),
+                    'lock_hold': dict((mode, h.as_dict()) for mode, h in self.lock_hold.iteritems()),
+                    'cache_size': self.size() if self.size is not None else None}
+
+
+class InstrumentedLock(object):
+    # Stands in for a rwlock.ReadWriteLock, timing how long it takes to get
+    # hold of the lock and how long it is held through read() and write().
+    def __init__(self, lock, metrics):
+        self.lock = lock
+        self.metrics = metrics
+
+    @contextmanager
+    def read(self):
+        start = time()
+        self.lock.acquireRead()
+        acquired = time()
+        try:
+            yield self
+        finally:
+            self.lock.release()
+            self.metrics.record_lock('read', acquired - start, time() - acquired)
+
+    @contextmanager
+    def write(self):
+        start = time()
+        self.lock.acquireWrite()
+        acquired = time()
+        try:
+            yield self
+        finally:
+            self.lock.release()
+            self.metrics.record_lock('write', acquired - start, time() - acquired)
+
+    def __getattr__(self, name):
+        return getattr(self.lock, name)
+
+
+def timed_misses(func, metrics):
+    # Wraps a function that resolves dispatch values, recording each call as a miss
+    def timed(*args, **kwargs):
+        start = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.record_miss(time() - start)
+    return timed
+
+
+def counted_calls(func, metrics):
+    def counted(*args, **kwargs):
+        metrics.record_call()
+        return func(*args, **kwargs)
+    counted.counted = func
+    return counted
@@ -6,6 +6,21 @@
 # the terms of this license.
 # You must not remove this notice, or any other, from this software.
 
+from abc import ABCMeta
+from collections import OrderedDict
+from contextlib import contextmanager
+from importlib import import_module
+from inspect import getmro
+from itertools import islice, izip, product
+from operator import mul, setitem
+from threading import Event, Lock
+from types import ClassType
+from weakref import WeakKeyDictionary, ref
+
+import dispatchindex
+import dispatchspec
+import metrics
+import rewarm
 import rwlock
 import versioneddict
 
@@ -14,6 +29,13 @@ class DefaultDispatchValue(object):
     pass
 
 
+# Matches anything at its position in a tuple dispatch value, as in
+# add_method(('rect', ANY))
+ANY = dispatchindex.ANY
+
+_DEFAULT = dispatchindex.DEFAULT
+
+
 class ArgumentConflict(Exception):
     pass
 
@@ -22,11 +44,301 @@ class PreferenceConflict(Exception):
     pass
 
 
+class MultiMethodSealed(Exception):
+    pass
+
+
+# Beyond this many changes in a batch, starting over with an empty cache beats
+# testing every cached dispatch value against each of them.
+_MAX_SELECTIVE_CHANGES = 64
+
+# Resolving a dispatch value is retried this many times when the tables or the
+# hierarchy change under it, before it is done under the write lock instead.
+_MAX_RESOLVE_ATTEMPTS = 4
+
+# How long a thread waits for another one resolving the same dispatch value,
+# in seconds, before it resolves it itself. The other thread may well be
+# waiting for a lock that this one holds.
+_FLIGHT_TIMEOUT = 0.1
+
+
+def _prefers(prefer_table, x, y):
+    try:
+        return y in prefer_table[x]
+    except KeyError:
+        return False
+
+
+def _select_best_method(name, hierarchy, prefer_table, dispatch_val, matches):
+    # matches holds the (dispatch value, method) pairs from a method table
+    # that dispatch_val is_a, in method table order.
+    def dominates(x, y):
+        return hierarchy.is_a(x, y) or _prefers(prefer_table, x, y)
+
+    best_match_dispatch_val = None
+    best_match_method = None
+    for other_dispatch_val, other_method in matches:
+        if best_match_dispatch_val is None or dominates(other_dispatch_val, best_match_dispatch_val):
+            best_match_dispatch_val = other_dispatch_val
+            best_match_method = other_method
+        if not dominates(best_match_dispatch_val, other_dispatch_val):
+            error = ArgumentConflict("Multiple methods in multimethod '{0}' match dispatch value: "
+                                     "{1} -> {2} and {3}, and neither is preferred".format(
+                                         name, dispatch_val, other_dispatch_val, best_match_dispatch_val))
+            # For those who want to sort it out with prefer_method
+            error.dispatch_val = dispatch_val
+            error.keys = (other_dispatch_val, best_match_dispatch_val)
+            raise error
+    return best_match_dispatch_val, best_match_method
+
+
+def _default_method(name, method_table, default_dispatch_val, dispatch_val):
+    try:
+        return method_table[default_dispatch_val]
+    except KeyError:
+        raise NotImplementedError("No method in multimethod '{0}' for dispatch value: {1}".format(
+            name, dispatch_val))
+
+
+def _evict(method_cache, affected):
+    # Returns how many entries went
+    evicted = 0
+    for dispatch_val in method_cache.keys():
+        if affected(dispatch_val):
+            if method_cache.pop(dispatch_val, None) is not None:
+                evicted += 1
+    return evicted
+
+
+def _recorded(dispatch_func, record):
+    # dispatch_func, passing every dispatch value it comes up with to record
+    def recording(*args, **kwargs):
+        dispatch_val = dispatch_func(*args, **kwargs)
+        record(dispatch_val)
+        return dispatch_val
+    recording.recorded = dispatch_func
+    return recording
+
+
+# The source of the functions MultiMethod.specialize generates. Names in
+# the namespace they are compiled in are spelled with leading underscores, so
+# that they cannot clash with the a0, a1, ... of the parameters.
+_SPECIALIZED_CALL = """
+def _call({params}):
+    dispatch_val = {dispatch}
+    if _hierarchy.__version__ == _multimethod.hierarchy_version{type_check}:
+        try:
+            target_func = _inline_cache[dispatch_val]
+        except KeyError:
+            target_func = _remember(dispatch_val)
+    else:
+        target_func = _multimethod.get_method(dispatch_val)
+    return target_func({params})
+"""
+
+
+def _specialized_code(multimethod, arity, namespace):
+    # Compiles the function specialize returns into namespace, for the
+    # dispatch function of multimethod as it is now, and returns it. While
+    # rewarming, that counts dispatch values, so the spec is not inlined.
+    if arity is None:
+        params = '*args, **kwargs'
+    else:
+        params = ', '.join('a{0}'.format(i) for i in xrange(arity))
+    namespace['_dispatch_func'] = multimethod.dispatch_func
+    if multimethod.dispatch_spec is not None and arity is not None and multimethod.rewarmer is None:
+        # Straight from the arguments, rather than through dispatch_func
+        dispatch = dispatchspec.expression(multimethod.dispatch_spec, params.split(', '), namespace)
+    else:
+        dispatch = '_dispatch_func({0})'.format(params)
+    source = _SPECIALIZED_CALL.format(
+        params=params,
+        dispatch=dispatch,
+        type_check=' and _ABCMeta._abc_invalidation_counter == _multimethod.abc_version'
+        if multimethod.type_dispatch else '')
+    exec compile(source, '<multimethod {0}>'.format(multimethod.name), 'exec') in namespace
+    return namespace.pop('_call')
+
+
+def _specialized_call(multimethod, arity, inline_cache_size):
+    inline_cache = {}
+    multimethod._inline_caches.append(inline_cache)
+
+    def remember(dispatch_val):
+        epoch = multimethod._inline_epoch
+        target_func = multimethod.get_method(dispatch_val)
+        if len(inline_cache) >= inline_cache_size:
+            inline_cache.clear()
+        inline_cache[dispatch_val] = target_func
+        # Invalidation moves the epoch on before it clears the inline caches,
+        # so if it got in since we looked this entry may be stale.
+        if multimethod._inline_epoch != epoch:
+            inline_cache.pop(dispatch_val, None)
+        return target_func
+
+    namespace = {'_multimethod': multimethod,
+                 '_hierarchy': multimethod.hierarchy,
+                 '_inline_cache': inline_cache,
+                 '_remember': remember,
+                 '_ABCMeta': ABCMeta}
+    call = _specialized_code(multimethod, arity, namespace)
+    call.__name__ = str(multimethod.name)
+    call.multimethod = multimethod
+    # So that MultiMethod._respecialize can find it again
+    multimethod._specialized.append((ref(call), arity))
+    return call
+
+
+class _LazyMethod(object):
+    # Stands in for a method registered by import path, 'package.module:function',
+    # until it is first called. That imports the module, and the function then
+    # takes the place of its stand-in wherever it is (see MultiMethod._swap_in).
+    def __init__(self, multimethod, path):
+        module, colon, name = path.partition(':')
+        if not (module and colon and name):
+            raise ValueError("Expected 'package.module:function', not {0!r}".format(path))
+        self.multimethod = multimethod
+        self.path = path
+        self.func = None
+        self._lock = Lock()
+
+    def __repr__(self):
+        return '<lazy method {0}>'.format(self.path)
+
+    def load(self):
+        # Imports the function if need be, just once, and returns it
+        loaded = False
+        with self._lock:
+            if self.func is None:
+                module, _, name = self.path.partition(':')
+                func = import_module(module)
+                for attribute in name.split('.'):
+                    func = getattr(func, attribute)
+                self.func = func
+                loaded = True
+        if loaded:
+            # Not under self._lock, which calls from under the multimethod's
+            # write lock may be waiting for
+            self.multimethod._swap_in(self, self.func)
+        return self.func
+
+    def __call__(self, *args, **kwargs):
+        func = self.func
+        if func is None:
+            func = self.load()
+        return func(*args, **kwargs)
+
+
+def _replace_values(mapping, old, new, setitem=setitem):
+    for key in list(mapping.keys()):
+        if mapping.get(key) is old:
+            setitem(mapping, key, new)
+
+
+class _Flight(object):
+    # A resolution under way, whose result the threads that miss on the same
+    # dispatch value meanwhile share
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class _TypeRelations(object):
+    # A hierarchy as type dispatch sees it: a class is_a whatever any class
+    # in its __mro__ is_a in the hierarchy, as well as whatever issubclass
+    # says it is, and ANY.
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+
+    def ancestors(self, cls):
+        ancestors = self.hierarchy.ancestors
+        result = set()
+        for base in getmro(cls):
+            result.update(ancestors.get(base, (base,)))
+        return result
+
+    def is_a(self, child, parent):
+        if parent is ANY:
+            return True
+        if isinstance(child, (type, ClassType)):
+            return parent in self.ancestors(child) or dispatchindex._is_subclass(child, parent)
+        return self.hierarchy.is_a(child, parent)
+
+
+class DispatchSnapshot(object):
+    # Immutable copy of everything a multimethod dispatches on: its method
+    # and prefer tables and a snapshot of its hierarchy. A copy on write
+    # multimethod publishes a new one whenever any of these changes, and
+    # resolves against the current one without taking locks. Since nothing
+    # in a snapshot changes, nothing cached for it needs invalidating either.
+    def __init__(self, multimethod, method_table, prefer_table, hierarchy):
+        self.name = multimethod.name
+        self.default_dispatch_val = multimethod.default_dispatch_val
+        self.factored = multimethod.factored
+        self.method_table = method_table
+        self.prefer_table = prefer_table
+        self.hierarchy = hierarchy
+        self.method_cache = multimethod._new_cache()
+        self.factored_index = None
+        self.ancestor_index = dispatchindex.AncestorIndex(method_table)
+
+    def _select_best_method(self, dispatch_val, matches):
+        return _select_best_method(self.name, self.hierarchy, self.prefer_table, dispatch_val, matches)
+
+    def _resolve(self, dispatch_val):
+        # Finds the method for a dispatch value the caches could not answer for
+        if self.factored and isinstance(dispatch_val, tuple):
+            index = self.factored_index
+            if index is None:
+                index = self.factored_index = dispatchindex.FactoredIndex(self.hierarchy, self.method_table)
+            return index.find_method(dispatch_val, self._select_best_method)
+        target_func = self._select_best_method(
+            dispatch_val, self.ancestor_index.matches(self.hierarchy, dispatch_val))[1]
+        if target_func is None:
+            target_func = _DEFAULT
+        self.method_cache[dispatch_val] = target_func
+        return target_func
+
+    def get_method(self, dispatch_val):
+        if self.factored and isinstance(dispatch_val, tuple):
+            index = self.factored_index
+            target_func = dispatchindex.MISSING if index is None else index.cached_method(dispatch_val)
+        else:
+            target_func = self.method_cache.get(dispatch_val, dispatchindex.MISSING)
+        if target_func is dispatchindex.MISSING:
+            target_func = self._resolve(dispatch_val)
+        if target_func is not None and target_func is not _DEFAULT:
+            return target_func
+        return _default_method(self.name, self.method_table, self.default_dispatch_val, dispatch_val)
+
+
 class MultiMethod(object):
-    def __init__(self, name, dispatch_func, default_dispatch_val=DefaultDispatchValue, hierarchy=None, default_func=None):
-        self.rw = rwlock.ReadWriteLock()
+    def __init__(self, name, dispatch_func, default_dispatch_val=DefaultDispatchValue, hierarchy=None, default_func=None,
+                 cache=None, factored=False, copy_on_write=None, type_dispatch=False, lock=None):
+        # Any of the locks in rwlock will do; see there for their trade-offs
+        self.rw = lock if lock is not None else rwlock.ReadWriteLock()
         self.name = name
 
+        # dispatch_func may be a spec from dispatchspec instead, which is
+        # compiled for the parameters the default method takes, so that calls
+        # can pass them by keyword as well. A default that takes too few of
+        # them, like def to_string(): pass, is only a placeholder, and says
+        # nothing about the parameters. Calls that pass their arguments
+        # positionally go through the builtin for a single spec, if any.
+        self.dispatch_spec = None
+        self.dispatch_arity = None
+        self._dispatch_getter = None
+        if dispatchspec.is_spec(dispatch_func):
+            self.dispatch_spec = dispatch_func
+            params = None if default_func is None else dispatchspec.fixed_parameters(default_func)
+            if params is not None and len(params) < dispatchspec.needed_arity(dispatch_func):
+                params = None
+            if params is not None:
+                self.dispatch_arity = len(params)
+            self._dispatch_getter = dispatchspec.getter(dispatch_func)
+            dispatch_func = dispatchspec.compile_spec(dispatch_func, names=params)
         self.dispatch_func = dispatch_func
         self.default_dispatch_val = default_dispatch_val
 
@@ -39,55 +351,295 @@ class MultiMethod(object):
         if default_func is not None:
             self.method_table[default_dispatch_val] = default_func
 
-        self.method_cache = {}
+        # In copy on write mode, every change publishes a new DispatchSnapshot
+        # and get_method only ever looks at the current snapshot, so dispatch
+        # never takes a lock. This needs a copy on write hierarchy, and is the
+        # default for multimethods on one.
+        if copy_on_write is None:
+            copy_on_write = hierarchy.copy_on_write and not type_dispatch
+        if copy_on_write and not hierarchy.copy_on_write:
+            raise ValueError("Copy on write multimethod '{0}' needs a copy on write hierarchy".format(name))
+        self.copy_on_write = copy_on_write
+        self.snapshot = None
 
-    def _reset_cache(self):
+        # Any dict-like object will do here; see methodcache for bounded ones.
+        # It serves as a template, of which the multimethod gets an empty copy
+        # of its own, so that passing one to several multimethods is fine.
+        self.cache = cache
+        self.method_cache = self._new_cache()
+
+        # With factored set, tuple dispatch values are resolved per argument
+        # position instead of through method_cache.
+        self.factored = factored
+        self.factored_index = None
+
+        # Finds the methods matching a dispatch value from its ancestors;
+        # built when first needed after every change to the method table.
+        self.ancestor_index = None
+
+        # See seal
+        self.sealed = False
+        self.sealed_methods = None
+
+        # The affected functions of the changes made so far in a batch, if
+        # one is under way
+        self._batch = None
+
+        # A metrics.Metrics while enable_metrics is in effect
+        self.metrics = None
+
+        # A rewarm.Rewarmer while enable_rewarming is in effect
+        self.rewarmer = None
+
+        # The inline caches of the functions specialize made, which are
+        # cleared along with everything else, and the number of times that
+        # happened
+        self._inline_caches = []
+        self._inline_epoch = 0
+        self._specialized = []
+
+        # Dispatch value -> _Flight, for resolutions under way
+        self._flights = {}
+        self._flights_lock = Lock()
+
+        # With type_dispatch set, class dispatch values are resolved through
+        # their __mro__ as well as the hierarchy (see _TypeRelations), and
+        # their methods are cached in type_cache, which does not keep the
+        # classes alive. Other dispatch values take the usual route.
+        self.type_dispatch = type_dispatch
+        self.type_cache = None
+        if type_dispatch:
+            if copy_on_write or factored or cache is not None:
+                raise ValueError("Type dispatch multimethod '{0}' cannot be copy on write, factored or have a "
+                                 "cache of its own".format(name))
+            self.type_cache = WeakKeyDictionary()
+            self.type_relations = _TypeRelations(hierarchy)
+            # ABCMeta.register changes what issubclass says without a new class
+            self.abc_version = ABCMeta._abc_invalidation_counter
+            self.get_method = self._get_type_method
+
+        if copy_on_write:
+            self._publish_lock = Lock()
+            self._reset_cache()
+            self.get_method = self._get_method_from_snapshot
+
+    def _new_cache(self):
+        # An empty cache like self.cache, for the multimethod or one of its snapshots
+        if self.cache is None:
+            return {}
+        fresh = getattr(self.cache, 'fresh', None)
+        return fresh() if fresh is not None else type(self.cache)()
+
+    def _publish_snapshot(self, method_table, prefer_table, affected=None):
+        # You must hold self._publish_lock to call this. Unless affected is None,
+        # the new snapshot inherits the cached methods of the current one, bar
+        # those of the dispatch values for which affected(dispatch_val) holds
+        # and those that changes to the hierarchy may have affected.
+        # Returns how many cached methods did not make it.
+        old_snapshot = self.snapshot
+        h = self.hierarchy.snapshot
+        snapshot = DispatchSnapshot(self, method_table, prefer_table, h)
+        if self.metrics is not None:
+            snapshot._resolve = metrics.timed_misses(snapshot._resolve, self.metrics)
+        self.snapshot = snapshot
+        self.method_cache = snapshot.method_cache
+        self.hierarchy_version = h.__version__
+        if old_snapshot is None:
+            return 0
+        old_cache = old_snapshot.method_cache
+        changed = None if affected is None else h.changed_since(old_snapshot.hierarchy.__version__)
+        if changed is None:
+            return len(old_cache)
+        for dispatch_val in old_cache.keys():
+            if not (affected(dispatch_val) or (changed and h.depends_on(dispatch_val, changed))):
+                target_func = old_cache.get(dispatch_val, None)
+                if target_func is not None:
+                    self.method_cache[dispatch_val] = target_func
+        return len(old_cache) - len(self.method_cache)
+
+    def _copy_tables(self):
+        # You must hold at least a read lock to call this
+        return (OrderedDict(self.method_table),
+                dict((x, frozenset(ys)) for x, ys in self.prefer_table.iteritems()))
+
+    def _record_invalidation(self, cause, evicted):
+        self._inline_epoch += 1
+        for inline_cache in self._inline_caches:
+            inline_cache.clear()
+        if self.metrics is not None:
+            self.metrics.record_invalidation(cause, evicted)
+        if evicted and self.rewarmer is not None:
+            self.rewarmer.wake()
+
+    def _reset_cache(self, cause='reset'):
         # You must hold a write lock for this object and a read lock on hierarchy to call this
-        self.method_cache.clear()
-        self.hierarchy_version = self.hierarchy.__version__
+        if self.copy_on_write:
+            with self._publish_lock:
+                evicted = self._publish_snapshot(*self._copy_tables())
+        else:
+            evicted = len(self.method_cache) + self._clear_type_cache()
+            self.method_cache.clear()
+            self.factored_index = None
+            self.ancestor_index = None
+            self.hierarchy_version = self.hierarchy.__version__
+        self._record_invalidation(cause, evicted)
+
+    def _clear_type_cache(self):
+        # Returns how many entries went
+        if self.type_cache is None:
+            return 0
+        evicted = len(self.type_cache)
+        self.type_cache.clear()
+        return evicted
+
+    def _sync_hierarchy(self):
+        # You must hold a write lock for this object and a read lock on hierarchy to call this.
+        # Catches up with changes to the hierarchy, forgetting only what they affect.
+        h = self.hierarchy
+        changed = h.changed_since(self.hierarchy_version)
+        if changed is None:
+            self._reset_cache('hierarchy')
+            return
+        if changed:
+            def affected(dispatch_val):
+                return h.depends_on(dispatch_val, changed)
+
+            # Classes outside the hierarchy can depend on it through their
+            # __mro__, which depends_on knows nothing about.
+            self._record_invalidation('hierarchy', _evict(self.method_cache, affected) + self._clear_type_cache())
+            index = self.factored_index
+            if index is not None:
+                if any(affected(key) for key in index.order):
+                    # The relationships between the methods changed too
+                    self.factored_index = None
+                else:
+                    index.forget(affected)
+        self.hierarchy_version = h.__version__
+
+    def _invalidate(self, affected, cause):
+        # You must hold a write lock for this object and a read lock on hierarchy to call this,
+        # after changing the method or prefer table. affected(dispatch_val) must hold for
+        # every dispatch value the change can send to another method.
+        if self._batch is not None:
+            self._batch.append(affected)
+            # Misses within the batch resolve against the changed tables
+            self.factored_index = None
+            self.ancestor_index = None
+            return
+        if self.copy_on_write:
+            with self._publish_lock:
+                evicted = self._publish_snapshot(*self._copy_tables(), affected=affected)
+        else:
+            self._sync_hierarchy()
+            evicted = _evict(self.method_cache, affected) + self._clear_type_cache()
+            self.factored_index = None
+            self.ancestor_index = None
+        self._record_invalidation(cause, evicted)
 
     def _prefers(self, x, y):
         # You must hold at least a read lock before calling this
-        try:
-            return y in self.prefer_table[x]
-        except KeyError:
-            return False
+        return _prefers(self.prefer_table, x, y)
 
-    def _dominates(self, x, y):
-        # To call this, you must call a read
-        return self.hierarchy.is_a(x, y) or self._prefers(x, y)
+    def _select_best_method(self, dispatch_val, matches):
+        # You must hold at least a read lock on this object and on the hierarchy to call this
+        return _select_best_method(self.name, self.hierarchy, self.prefer_table, dispatch_val, matches)
+
+    def _ancestor_index(self):
+        # You must hold at least a read lock to call this
+        index = self.ancestor_index
+        if index is None:
+            index = self.ancestor_index = dispatchindex.AncestorIndex(self.method_table)
+        return index
+
+    def _matches(self, dispatch_val):
+        # You must hold at least a read lock on this object and on the hierarchy to call this
+        return self._ancestor_index().matches(self.hierarchy, dispatch_val)
+
+    def _single_flight(self, dispatch_val, resolve):
+        # Calls resolve(dispatch_val), unless another thread is resolving
+        # dispatch_val already, in which case its result is ours too. Not if
+        # the cache was invalidated since it started, though: its result may
+        # predate a change this thread made and expects to see.
+        epoch = self._inline_epoch
+        with self._flights_lock:
+            flight = self._flights.get(dispatch_val)
+            leading = flight is None or flight.epoch != epoch
+            if leading:
+                flight = self._flights[dispatch_val] = _Flight(epoch)
+        if not leading:
+            if not flight.done.wait(_FLIGHT_TIMEOUT):
+                return resolve(dispatch_val)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = resolve(dispatch_val)
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._flights_lock:
+                if self._flights.get(dispatch_val) is flight:
+                    del self._flights[dispatch_val]
+            flight.done.set()
+        return flight.result
 
     def _find_and_cache_best_method(self, dispatch_val):
-        while True:
+        return self._single_flight(dispatch_val, self._resolve_and_cache)
+
+    def _resolve_and_cache(self, dispatch_val):
+        for _ in xrange(_MAX_RESOLVE_ATTEMPTS):
             h = self.hierarchy
             with self.rw.read(), h.rw.read():
-                best_match_dispatch_val = None
-                best_match_method = None
                 method_table_version = self.method_table.__version__
                 prefer_table_version = self.prefer_table.__version__
+                hierarchy_version = h.__version__
 
-                for other_dispatch_val, other_method in self.method_table.iteritems():
-                    if h.is_a(dispatch_val, other_dispatch_val):
-                        if (best_match_dispatch_val is None
-                                or self._dominates(other_dispatch_val, best_match_dispatch_val)):
-                            best_match_dispatch_val = other_dispatch_val
-                            best_match_method = other_method
-                        if not self._dominates(best_match_dispatch_val, other_dispatch_val):
-                            raise ArgumentConflict("Multiple methods in multimethod '{0}' match dispatch value: " \
-                                            "{1} -> {2} and {3}, and neither is preferred",
-                                            self.name, dispatch_val, other_dispatch_val, best_match_dispatch_val)
+                best_match_dispatch_val, best_match_method = self._select_best_method(
+                    dispatch_val, self._matches(dispatch_val))
 
                 if best_match_dispatch_val is None:
-                    return None
+                    # Cached as well, so that the default method is a hit too
+                    best_match_method = _DEFAULT
 
             with self.rw.write(), self.hierarchy.rw.read():
                 if (self.method_table.__version__ == method_table_version
                         and self.prefer_table.__version__ == prefer_table_version
-                        and self.hierarchy_version == self.hierarchy.__version__):
+                        and self.hierarchy.__version__ == hierarchy_version
+                        and self.hierarchy_version == hierarchy_version):
                     self.method_cache[dispatch_val] = best_match_method
                     return best_match_method
                 else:
-                    self._reset_cache()
+                    # Whoever changed the tables evicted what the change
+                    # affected; catch up with the hierarchy and try again.
+                    self._sync_hierarchy()
+
+        # Still changing under us; nothing can while we hold the write lock
+        with self.rw.write(), self.hierarchy.rw.read():
+            self._sync_hierarchy()
+            best_match_method = self._select_best_method(dispatch_val, self._matches(dispatch_val))[1]
+            if best_match_method is None:
+                best_match_method = _DEFAULT
+            self.method_cache[dispatch_val] = best_match_method
+            return best_match_method
+
+    def _find_factored_method(self, dispatch_val):
+        # Resolves a tuple dispatch value through the per-argument index,
+        # without touching method_cache; see dispatchindex.FactoredIndex.
+        index = self.factored_index
+        if index is not None:
+            target_func = index.cached_method(dispatch_val)
+            if target_func is not dispatchindex.MISSING:
+                return target_func
+        return self._resolve_factored(dispatch_val)
+
+    def _resolve_factored(self, dispatch_val):
+        h = self.hierarchy
+        with self.rw.read(), h.rw.read():
+            index = self.factored_index
+            if index is None:
+                index = self.factored_index = dispatchindex.FactoredIndex(h, self.method_table)
+            return index.find_method(dispatch_val, self._select_best_method)
 
     def get_method(self, dispatch_val):
         # It could happen that the hierarchy is in the process of
@@ -105,36 +657,499 @@ class MultiMethod(object):
         # synchronization if it is important for your application.
         if self.hierarchy_version != self.hierarchy.__version__:
             with self.rw.write(), self.hierarchy.rw.read():
-                self._reset_cache()
-        target_func = self.method_cache.get(dispatch_val, None)
-        if target_func is not None:
+                self._sync_hierarchy()
+        if self.factored and isinstance(dispatch_val, tuple):
+            target_func = self._find_factored_method(dispatch_val)
+            if target_func is None:
+                target_func = _DEFAULT
+        else:
+            target_func = self.method_cache.get(dispatch_val, None)
+            if target_func is None:
+                target_func = self._find_and_cache_best_method(dispatch_val)
+        if target_func is not _DEFAULT:
             return target_func
-        target_func = self._find_and_cache_best_method(dispatch_val)
-        if target_func is not None:
+        return _default_method(self.name, self.method_table, self.default_dispatch_val, dispatch_val)
+
+    def _get_method_from_snapshot(self, dispatch_val):
+        # Stands in for get_method in copy on write mode. The publish lock is
+        # only taken once per hierarchy change, to move to its new snapshot.
+        snapshot = self.snapshot
+        if snapshot.hierarchy is not self.hierarchy.snapshot:
+            with self._publish_lock:
+                snapshot = self.snapshot
+                if snapshot.hierarchy is not self.hierarchy.snapshot:
+                    self._record_invalidation('hierarchy', self._publish_snapshot(
+                        snapshot.method_table, snapshot.prefer_table, affected=lambda dispatch_val: False))
+                    snapshot = self.snapshot
+        return snapshot.get_method(dispatch_val)
+
+    def _type_matches(self, cls):
+        # You must hold at least a read lock on this object and on the hierarchy to call this
+        index = self._ancestor_index()
+        ancestors = self.type_relations.ancestors(cls)
+        members = index.keys.members
+        keys = [key for key in ancestors if key in members]
+        keys.extend(key for key in index.keys.checked
+                    if key not in ancestors and dispatchindex._is_subclass(cls, key))
+        if index.keys.wildcard and ANY not in keys:
+            keys.append(ANY)
+        method_table = self.method_table
+        return [(key, method_table[key]) for key in sorted(keys, key=index.order.__getitem__)]
+
+    def _select_best_type_method(self, cls):
+        # You must hold at least a read lock on this object and on the hierarchy to call this
+        return _select_best_method(self.name, self.type_relations, self.prefer_table, cls, self._type_matches(cls))
+
+    def _sync_types(self):
+        # You must hold a write lock for this object and a read lock on hierarchy to call this
+        self._sync_hierarchy()
+        if self.abc_version != ABCMeta._abc_invalidation_counter:
+            self._record_invalidation('abc', self._clear_type_cache())
+            self.abc_version = ABCMeta._abc_invalidation_counter
+
+    def _find_and_cache_type_method(self, cls):
+        return self._single_flight(cls, self._resolve_and_cache_type)
+
+    def _resolve_and_cache_type(self, cls):
+        for _ in xrange(_MAX_RESOLVE_ATTEMPTS):
+            h = self.hierarchy
+            with self.rw.read(), h.rw.read():
+                method_table_version = self.method_table.__version__
+                prefer_table_version = self.prefer_table.__version__
+                hierarchy_version = h.__version__
+                abc_version = ABCMeta._abc_invalidation_counter
+                best_match_method = self._select_best_type_method(cls)[1]
+                if best_match_method is None:
+                    best_match_method = _DEFAULT
+
+            with self.rw.write(), h.rw.read():
+                if (self.method_table.__version__ == method_table_version
+                        and self.prefer_table.__version__ == prefer_table_version
+                        and h.__version__ == hierarchy_version
+                        and self.hierarchy_version == hierarchy_version
+                        and self.abc_version == abc_version == ABCMeta._abc_invalidation_counter):
+                    self.type_cache[cls] = best_match_method
+                    return best_match_method
+                else:
+                    self._sync_types()
+
+        with self.rw.write(), self.hierarchy.rw.read():
+            self._sync_types()
+            best_match_method = self._select_best_type_method(cls)[1]
+            if best_match_method is None:
+                best_match_method = _DEFAULT
+            self.type_cache[cls] = best_match_method
+            return best_match_method
+
+    def _get_type_method(self, dispatch_val):
+        # Stands in for get_method with type_dispatch set
+        if (self.hierarchy_version != self.hierarchy.__version__
+                or self.abc_version != ABCMeta._abc_invalidation_counter):
+            with self.rw.write(), self.hierarchy.rw.read():
+                self._sync_types()
+        if not isinstance(dispatch_val, (type, ClassType)):
+            return MultiMethod.get_method(self, dispatch_val)
+        # Same as type_cache.get, without its Python level call
+        target_func = self.type_cache.data.get(ref(dispatch_val))
+        if target_func is None:
+            target_func = self._find_and_cache_type_method(dispatch_val)
+        if target_func is not _DEFAULT:
             return target_func
+        return _default_method(self.name, self.method_table, self.default_dispatch_val, dispatch_val)
+
+    def _dispatch_universe(self, max_entries, skipped=None):
+        # You must hold at least a read lock on this object and on the hierarchy to call this.
+        # Lists every node of the hierarchy and, as far as that keeps the total
+        # under max_entries, every tuple of nodes that could match a tuple key.
+        # The arities whose tuples did not fit go into skipped, if given, with
+        # the number of tuples each would have taken.
+        h = self.hierarchy
+        nodes = list(h.ancestors)
+        dispatch_vals = list(nodes)
+        for arity, components in sorted(self._ancestor_index().component_nodes(h, nodes).iteritems()):
+            size = reduce(mul, map(len, components), 1)
+            if len(dispatch_vals) + size <= max_entries:
+                dispatch_vals.extend(product(*components))
+            elif skipped is not None:
+                skipped[arity] = size
+        return dispatch_vals
+
+    def _best_match(self, dispatch_val):
+        # You must hold at least a read lock on this object and on the hierarchy to call this.
+        # Returns the key and method dispatch_val goes to, (None, None) for the default.
+        if self.type_dispatch and isinstance(dispatch_val, (type, ClassType)):
+            return self._select_best_type_method(dispatch_val)
+        return self._select_best_method(dispatch_val, self._matches(dispatch_val))
+
+    def _resolve_keys(self, dispatch_vals):
+        # You must hold at least a read lock on this object and on the hierarchy to call this.
+        # Yields (dispatch value, key) pairs, where key is the method table key
+        # of the method each of dispatch_vals goes to, the default one
+        # included. Leaves out those that get_method would raise about.
+        for dispatch_val in dispatch_vals:
+            try:
+                key = self._best_match(dispatch_val)[0]
+            except ArgumentConflict:
+                continue
+            if key is None:
+                if self.default_dispatch_val not in self.method_table:
+                    continue
+                key = self.default_dispatch_val
+            yield dispatch_val, key
+
+    def precompute(self, max_entries=100000):
+        # Resolves every node of the hierarchy and, as far as that keeps the
+        # total under max_entries, every tuple of nodes that could match a
+        # tuple key, and caches what it found, so that calls on them start
+        # out as hits (those that go to the default method included). Returns a report of what it found, a dict with
+        # * 'resolved': the number of dispatch values with a method of their own,
+        # * 'default': the number of them that go to the default method,
+        # * 'unhandled': those that would raise NotImplementedError,
+        # * 'ambiguous': for every pair of keys that dispatch values match
+        #   with neither preferred, the list of those values. Each pair needs
+        #   a prefer_method; until then the values raise ArgumentConflict.
+        # * 'skipped': the number of tuples of nodes left out for exceeding
+        #   max_entries, by arity. Nothing was checked about those, so the
+        #   report only vouches for them when this is empty.
+        while True:
+            h = self.hierarchy
+            with self.rw.read(), h.rw.read():
+                versions = (self.method_table.__version__, self.prefer_table.__version__, h.__version__)
+                found = {}
+                default = 0
+                unhandled = []
+                ambiguous = {}
+                skipped = {}
+                for dispatch_val in self._dispatch_universe(max_entries, skipped):
+                    try:
+                        key, method = self._best_match(dispatch_val)
+                    except ArgumentConflict as error:
+                        x, y = error.keys
+                        pair = (y, x) if (y, x) in ambiguous else (x, y)
+                        ambiguous.setdefault(pair, []).append(dispatch_val)
+                        continue
+                    if key is None:
+                        method = _DEFAULT
+                        if self.default_dispatch_val in self.method_table:
+                            default += 1
+                        else:
+                            unhandled.append(dispatch_val)
+                    found[dispatch_val] = method
+            report = {'resolved': len(found) - default - len(unhandled), 'default': default,
+                      'unhandled': unhandled, 'ambiguous': ambiguous, 'skipped': skipped}
+
+            if self.copy_on_write:
+                # Snapshots cache what they resolve themselves
+                self._resolve_all(found)
+                return report
+            with self.rw.write(), h.rw.read():
+                if (self.method_table.__version__, self.prefer_table.__version__, h.__version__) == versions \
+                        and self.hierarchy_version == h.__version__:
+                    for dispatch_val, method in found.iteritems():
+                        if self.factored and isinstance(dispatch_val, tuple):
+                            continue
+                        if self.type_dispatch and isinstance(dispatch_val, (type, ClassType)):
+                            continue
+                        self.method_cache[dispatch_val] = method
+                    break
+                # Changed while we were at it; catch up and start over
+                self._sync_hierarchy()
+        if self.factored:
+            # Tuples are cached by the factored index, which get_method fills
+            self._resolve_all(dispatch_val for dispatch_val in found if isinstance(dispatch_val, tuple))
+        if self.type_dispatch:
+            # Classes are cached by type_cache, which get_method fills
+            self._resolve_all(dispatch_val for dispatch_val in found if isinstance(dispatch_val, (type, ClassType)))
+        return report
+
+    def _resolve_all(self, dispatch_vals):
+        for dispatch_val in dispatch_vals:
+            try:
+                self.get_method(dispatch_val)
+            except (ArgumentConflict, NotImplementedError):
+                pass
+
+    def seal(self, max_entries=100000):
+        # Resolves every node of the (frozen) hierarchy and, as far as that
+        # keeps the total under max_entries, every tuple of nodes that could
+        # match a tuple key. get_method then looks dispatch values up in the
+        # result without locks or version checks; only values missing from it
+        # take the usual route. The method and prefer tables cannot change
+        # any more, add_method and friends raise MultiMethodSealed.
+        h = self.hierarchy
+        with self.rw.write(), h.rw.read():
+            if self.sealed:
+                return self
+            if not h.frozen:
+                raise ValueError("Multimethod '{0}' can only be sealed once its hierarchy is frozen".format(self.name))
+            method_table = self.method_table
+            self.sealed_methods = dict((dispatch_val, method_table[key])
+                                       for dispatch_val, key in self._resolve_keys(self._dispatch_universe(max_entries)))
+            self._unsealed_get_method = getattr(self.get_method, 'counted', self.get_method)
+            self.get_method = self._get_sealed_method
+            if self.metrics is not None:
+                self.get_method = metrics.counted_calls(self.get_method, self.metrics)
+            self.sealed = True
+        return self
+
+    def _get_sealed_method(self, dispatch_val):
+        # Stands in for get_method once sealed
         try:
-            return self.method_table[self.default_dispatch_val]
+            return self.sealed_methods[dispatch_val]
         except KeyError:
-            raise NotImplementedError("No method in multimethod '{0}' for dispatch value: {1}".format(
-                self.name, dispatch_val))
+            return self._unsealed_get_method(dispatch_val)
+
+    @contextmanager
+    def batch(self):
+        # Makes the add_method, remove_method and prefer_method calls in the
+        # with block under a single write lock, and invalidates whatever they
+        # affect once, when it exits. Should the block raise, the method and
+        # prefer tables are put back the way they were, and whatever was
+        # resolved against them in the meantime is forgotten.
+        with self.rw.write():
+            if self._batch is not None:
+                # Part of an enclosing batch
+                yield self
+                return
+            self._check_unsealed()
+            method_table, prefer_table = self._copy_tables()
+            self._batch = []
+            try:
+                yield self
+            except:
+                changes, self._batch = self._batch, None
+                self.method_table.clear()
+                self.method_table.update(method_table)
+                self.prefer_table.clear()
+                self.prefer_table.update(prefer_table)
+                self._invalidate_batch(changes)
+                raise
+            changes, self._batch = self._batch, None
+            self._invalidate_batch(changes)
+
+    def _invalidate_batch(self, changes):
+        # You must hold a write lock for this object to call this
+        if changes:
+            with self.hierarchy.rw.read():
+                if len(changes) > _MAX_SELECTIVE_CHANGES:
+                    self._reset_cache('batch')
+                else:
+                    self._invalidate(lambda dispatch_val: any(affected(dispatch_val) for affected in changes),
+                                     'batch')
+
+    def enable_metrics(self, on_event=None):
+        # Starts counting calls, misses and invalidations and timing
+        # resolution and the lock, and returns the metrics.Metrics that all
+        # of it goes to. Leaves on_event alone if metrics are on already.
+        with self.rw.write():
+            if self.metrics is None:
+                recorder = self.metrics = metrics.Metrics(on_event)
+                recorder.size = lambda: len(self.method_cache)
+                self.rw = metrics.InstrumentedLock(self.rw, recorder)
+                self.get_method = metrics.counted_calls(self.get_method, recorder)
+                self._find_and_cache_best_method = metrics.timed_misses(self._find_and_cache_best_method, recorder)
+                self._resolve_factored = metrics.timed_misses(self._resolve_factored, recorder)
+                self._find_and_cache_type_method = metrics.timed_misses(self._find_and_cache_type_method, recorder)
+                if self.copy_on_write:
+                    with self._publish_lock:
+                        snapshot = self.snapshot
+                        snapshot._resolve = metrics.timed_misses(snapshot._resolve, recorder)
+            return self.metrics
+
+    def disable_metrics(self):
+        with self.rw.write():
+            if self.metrics is None:
+                return
+            self.metrics = None
+            self.rw = self.rw.lock
+            self.get_method = self.get_method.counted
+            del self._find_and_cache_best_method
+            del self._resolve_factored
+            del self._find_and_cache_type_method
+            if self.copy_on_write:
+                with self._publish_lock:
+                    self.snapshot.__dict__.pop('_resolve', None)
+
+    def enable_rewarming(self, max_keys=256):
+        # Starts counting dispatch values, and has a worker thread resolve the
+        # max_keys most frequent ones again whenever anything is evicted from
+        # the cache, while calls carry on as usual. Returns the
+        # rewarm.Rewarmer doing it. Leaves max_keys alone if it is on already.
+        with self.rw.write():
+            if self.rewarmer is None:
+                if isinstance(self.rw, rwlock.NullLock) or isinstance(self.hierarchy.rw, rwlock.NullLock):
+                    raise ValueError("Multimethod '{0}' cannot be rewarmed from another thread without "
+                                     "locking".format(self.name))
+                self.rewarmer = rewarm.Rewarmer(self._rewarm, max_keys, self.name)
+                self._record_dispatch_vals(self.rewarmer.record)
+            return self.rewarmer
+
+    def disable_rewarming(self):
+        with self.rw.write():
+            rewarmer, self.rewarmer = self.rewarmer, None
+            if rewarmer is None:
+                return
+            self._record_dispatch_vals(None)
+        # Outside the lock, which the worker may be waiting for
+        rewarmer.cancel()
+
+    def _record_dispatch_vals(self, record):
+        # You must hold a write lock to call this. Has record see the dispatch
+        # value of every call, or stops that if record is None.
+        if record is None:
+            self.dispatch_func = self.dispatch_func.recorded
+            if self.dispatch_spec is not None:
+                self._dispatch_getter = dispatchspec.getter(self.dispatch_spec)
+        else:
+            self.dispatch_func = _recorded(self.dispatch_func, record)
+            # Every call goes through dispatch_func meanwhile
+            self._dispatch_getter = None
+        self._respecialize()
+
+    def _respecialize(self):
+        # You must hold a write lock to call this. Brings the functions made
+        # by specialize up to date with dispatch_func, by giving them freshly
+        # generated code; their globals stay the namespace they were made in.
+        specialized = []
+        for call_ref, arity in self._specialized:
+            call = call_ref()
+            if call is not None:
+                call.func_code = _specialized_code(self, arity, call.func_globals).func_code
+                specialized.append((call_ref, arity))
+        self._specialized = specialized
+
+    def _rewarm(self, dispatch_vals, interrupted, chunksize=64):
+        # Resolves dispatch_vals a chunk at a time under read locks, so as not
+        # to hold up writers for long, and caches them all at once under the
+        # write lock if nothing changed meanwhile. Gives up as soon as
+        # interrupted() holds. Returns how many it cached.
+        if self.copy_on_write or self.factored or self.type_dispatch:
+            # Whatever get_method resolves goes where it belongs
+            count = 0
+            for dispatch_val in dispatch_vals:
+                if interrupted():
+                    break
+                try:
+                    self.get_method(dispatch_val)
+                except (ArgumentConflict, NotImplementedError, TypeError):
+                    continue
+                count += 1
+            return count
+        h = self.hierarchy
+        versions = None
+        found = {}
+        for start in xrange(0, len(dispatch_vals), chunksize):
+            if interrupted():
+                return 0
+            with self.rw.read(), h.rw.read():
+                current = (self.method_table.__version__, self.prefer_table.__version__, h.__version__)
+                if versions is None:
+                    versions = current
+                elif current != versions:
+                    return 0
+                for dispatch_val in dispatch_vals[start:start + chunksize]:
+                    try:
+                        key, method = self._best_match(dispatch_val)
+                    except (ArgumentConflict, TypeError):
+                        continue
+                    found[dispatch_val] = _DEFAULT if key is None else method
+        with self.rw.write(), h.rw.read():
+            # Until get_method catches up with the hierarchy, what it would
+            # evict then may still be cached
+            if (self.method_table.__version__, self.prefer_table.__version__, h.__version__) != versions \
+                    or self.hierarchy_version != h.__version__ or interrupted():
+                return 0
+            for dispatch_val, method in found.iteritems():
+                self.method_cache[dispatch_val] = method
+        return len(found)
+
+    def _check_unsealed(self):
+        if self.sealed:
+            raise MultiMethodSealed("Multimethod '{0}' is sealed and cannot be changed".format(self.name))
 
     def __call__(self, *args, **kwargs):
+        dispatch_getter = self._dispatch_getter
+        if dispatch_getter is not None and args and not kwargs:
+            return self.get_method(dispatch_getter(args[0]))(*args)
         return self.get_method(self.dispatch_func(*args, **kwargs))(*args, **kwargs)
 
+    def specialize(self, arity=None, inline_cache_size=8):
+        # Returns a function that calls the multimethod, for hot paths. It is
+        # generated for the number of positional arguments its dispatch
+        # function takes (or arity, if given), and remembers the methods of
+        # the last inline_cache_size dispatch values it saw, so that calling
+        # it costs little more than calling the dispatch function and the
+        # method. Without a fixed arity it takes *args and **kwargs like the
+        # multimethod itself. Call this once and keep the result. With a
+        # dispatch spec, the dispatch value is taken from the arguments in
+        # the function itself.
+        if arity is None:
+            if self.dispatch_spec is not None:
+                arity = self.dispatch_arity
+            else:
+                arity = dispatchspec.fixed_arity(self.dispatch_func)
+        return _specialized_call(self, arity, inline_cache_size)
+
+    def imap(self, records, dispatch_vals=None, labels=None, chunksize=1024):
+        # Calls the multimethod on every record in turn, yielding the results
+        # in order. Records are taken chunksize at a time and every distinct
+        # dispatch value in a chunk is resolved once, so only a chunk's worth
+        # of records and methods is held at any time. Changes to the
+        # hierarchy or the tables take effect from the next chunk on.
+        #
+        # dispatch_vals, if given, holds the dispatch value of each record
+        # and dispatch_func is not called. It may be a numpy array of codes,
+        # in which case labels[code] is the dispatch value of a code.
+        records = iter(records)
+        is_array = hasattr(dispatch_vals, 'tolist')
+        if dispatch_vals is not None and not is_array:
+            dispatch_vals = iter(dispatch_vals)
+        get_method = self.get_method
+        start = 0
+        while True:
+            chunk = list(islice(records, chunksize))
+            if not chunk:
+                return
+            if dispatch_vals is None:
+                dispatch_func = self.dispatch_func
+                chunk_vals = [dispatch_func(record) for record in chunk]
+            elif is_array:
+                chunk_vals = dispatch_vals[start:start + len(chunk)].tolist()
+            else:
+                chunk_vals = list(islice(dispatch_vals, len(chunk)))
+            if len(chunk_vals) != len(chunk):
+                raise ValueError("There are fewer dispatch values than records")
+            start += len(chunk)
+            methods = {}
+            for dispatch_val in chunk_vals:
+                if dispatch_val not in methods:
+                    methods[dispatch_val] = get_method(dispatch_val if labels is None else labels[dispatch_val])
+            for record, dispatch_val in izip(chunk, chunk_vals):
+                yield methods[dispatch_val](record)
+
+    def map(self, records, dispatch_vals=None, labels=None, chunksize=1024):
+        # The results of imap as a list
+        return list(self.imap(records, dispatch_vals, labels, chunksize))
+
     def prefer_method(self, dispatch_val_x, dispatch_val_y):
         if isinstance(dispatch_val_x, list):
             dispatch_val_x = tuple(dispatch_val_x)
         if isinstance(dispatch_val_y, list):
             dispatch_val_y = tuple(dispatch_val_y)
         with self.rw.write(), self.hierarchy.rw.read():
+            self._check_unsealed()
             if self._prefers(dispatch_val_y, dispatch_val_x):
                 raise PreferenceConflict("Preference conflict in multimethod '{0}': {1} is already preferred over {2}".format(
                     self.name, dispatch_val_y, dispatch_val_x))
-            try:
-                self.prefer_table[dispatch_val_x].add(dispatch_val_y)
-            except KeyError:
-                self.prefer_table[dispatch_val_x] = {dispatch_val_y}
-            self._reset_cache()
+            # Replace rather than update the set, so that the table's version changes
+            preferred = set(self.prefer_table.get(dispatch_val_x, ()))
+            preferred.add(dispatch_val_y)
+            self.prefer_table[dispatch_val_x] = preferred
+            h = self.hierarchy
+            matches_x = dispatchindex.compile_matcher(dispatch_val_x)
+            matches_y = dispatchindex.compile_matcher(dispatch_val_y)
+            self._invalidate(lambda dispatch_val: matches_x(h, dispatch_val) and matches_y(h, dispatch_val),
+                             'prefer_method')
             return self
 
     def add_method(self, dispatch_val):
@@ -143,13 +1158,45 @@ class MultiMethod(object):
 
         def decorator(func):
             with self.rw.write(), self.hierarchy.rw.read():
+                self._check_unsealed()
                 self.method_table[dispatch_val] = func
-                self._reset_cache()
+                h = self.hierarchy
+                matches = dispatchindex.compile_matcher(dispatch_val)
+                self._invalidate(lambda other_dispatch_val: matches(h, other_dispatch_val), 'add_method')
                 return self
         return decorator
 
+    def add_lazy_method(self, dispatch_val, path):
+        # Registers the function at path, as in 'package.module:function', for
+        # dispatch_val without importing anything. The module is imported when
+        # the method is first called; until then, get_method returns a stand-in
+        # for it.
+        return self.add_method(dispatch_val)(_LazyMethod(self, path))
+
+    def _swap_in(self, lazy, func):
+        # Puts func in the place of its stand-in lazy in the tables and caches.
+        # Which method goes with which dispatch value stays the same, so the
+        # method table keeps its version and nothing is invalidated.
+        with self.rw.write():
+            _replace_values(self.method_table, lazy, func, OrderedDict.__setitem__)
+            mappings = [self.method_cache] + self._inline_caches
+            if self.type_cache is not None:
+                mappings.append(self.type_cache)
+            if self.sealed:
+                mappings.append(self.sealed_methods)
+            for mapping in mappings:
+                _replace_values(mapping, lazy, func)
+            if self.copy_on_write:
+                with self._publish_lock:
+                    snapshot = self.snapshot
+                    _replace_values(snapshot.method_table, lazy, func, OrderedDict.__setitem__)
+                    _replace_values(snapshot.method_cache, lazy, func)
+
     def remove_method(self, dispatch_val):
         with self.rw.write(), self.hierarchy.rw.read():
+            self._check_unsealed()
             del self.method_table[dispatch_val]
-            self._reset_cache()
+            h = self.hierarchy
+            matches = dispatchindex.compile_matcher(dispatch_val)
+            self._invalidate(lambda other_dispatch_val: matches(h, other_dispatch_val), 'remove_method')
             return self
@@ -0,0 +1,77 @@
+__author__ = 'wynand'
+
+# Background re-resolution of the hottest dispatch values of a multimethod,
+# so that invalidating its cache does not leave all of its traffic to pay for
+# resolving them again. See MultiMethod.enable_rewarming.
+#
+# A Rewarmer counts the dispatch values it is shown. Counts are kept for at
+# most 4 * max_keys of them; beyond that only the max_keys most frequent are
+# kept, at half their counts, so that values that stopped coming in fade
+# out. Whenever the multimethod evicts something from its cache it wakes the
+# worker thread, which hands the max_keys most frequent values to resolve. A
+# wake-up that comes in meanwhile interrupts that round and starts another,
+# against the tables as they are by then.
+
+from heapq import nlargest
+from operator import itemgetter
+import threading
+
+
+class Rewarmer(object):
+    def __init__(self, resolve, max_keys=256, name='multimethod'):
+        # resolve(dispatch_vals, interrupted) resolves and caches dispatch_vals,
+        # giving up once interrupted() holds, and returns how many it cached.
+        if max_keys < 1:
+            raise ValueError("max_keys must be at least 1, not {0}".format(max_keys))
+        self.resolve = resolve
+        self.max_keys = max_keys
+        self.counts = {}
+        # Rounds completed or interrupted, and dispatch values they cached
+        self.rounds = 0
+        self.rewarmed = 0
+        self._wake = threading.Event()
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run, name='multimethod-rewarm-{0}'.format(name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, dispatch_val):
+        counts = self.counts
+        try:
+            counts[dispatch_val] = counts.get(dispatch_val, 0) + 1
+        except TypeError:
+            # Unhashable, which get_method will complain about
+            return
+        if len(counts) > 4 * self.max_keys:
+            self.counts = dict((dispatch_val, (count + 1) // 2) for dispatch_val, count in self._top(counts))
+
+    def _top(self, counts):
+        # items() copies the dict in one go, unlike iterating over it while
+        # other threads record
+        return nlargest(self.max_keys, counts.items(), key=itemgetter(1))
+
+    def hottest(self):
+        # The max_keys most frequent dispatch values, most frequent first
+        return [dispatch_val for dispatch_val, _ in self._top(self.counts)]
+
+    def wake(self):
+        self._wake.set()
+
+    def _interrupted(self):
+        return self._cancelled or self._wake.is_set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            if self._cancelled:
+                return
+            self._wake.clear()
+            self.rewarmed += self.resolve(self.hottest(), self._interrupted)
+            self.rounds += 1
+
+    def cancel(self, timeout=None):
+        # Stops the worker, interrupting whatever round is under way, and
+        # waits for it (for at most timeout seconds, if given)
+        self._cancelled = True
+        self._wake.set()
+        self._thread.join(timeout)
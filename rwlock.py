@@ -16,6 +16,7 @@ from time import time
 
 # ww
 from contextlib import contextmanager
+from thread import get_ident
 
 # Read write lock
 # ---------------
@@ -242,3 +243,206 @@ class ReadWriteLock(object):
             yield self
         finally:
             self.release()
+
+
+# ww: lighter alternatives to ReadWriteLock, for Hierarchy(lock=...) and
+# MultiMethod(lock=...). All of them let the writer take nested read and write
+# locks, but not a reader upgrade to a write lock, which the multimethod code
+# never does; nor do they take timeouts.
+
+class NullLock(object):
+    # Does no locking whatsoever, for hierarchies and multimethods that only
+    # one thread ever touches.
+    def acquireRead(self):
+        pass
+
+    def acquireWrite(self):
+        pass
+
+    def release(self):
+        pass
+
+    def read(self):
+        return self
+
+    def write(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _Section(object):
+    # What read() and write() return: a context manager that is cheaper to
+    # enter than a contextlib.contextmanager generator
+    __slots__ = ('acquire', 'release')
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class CountingLock(object):
+    # Readers just count themselves in and out under a mutex, and only wait
+    # while a writer holds the lock. Writers wait until the count drops to
+    # zero. Readers are preferred (new ones do not wait for waiting writers),
+    # which is what lets read locks nest without keeping track of readers per
+    # thread, but also lets a steady stream of readers starve writers.
+    def __init__(self):
+        self._mutex = Lock()
+        self._condition = Condition(self._mutex)
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._read = _Section(self.acquireRead, self.release)
+        self._write = _Section(self.acquireWrite, self.release)
+
+    def acquireRead(self):
+        self._mutex.acquire()
+        try:
+            if self._writer is not None:
+                if self._writer == get_ident():
+                    self._depth += 1
+                    return
+                while self._writer is not None:
+                    self._condition.wait()
+            self._readers += 1
+        finally:
+            self._mutex.release()
+
+    def acquireWrite(self):
+        me = get_ident()
+        self._mutex.acquire()
+        try:
+            if self._writer == me:
+                self._depth += 1
+                return
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._writer = me
+            self._depth = 1
+        finally:
+            self._mutex.release()
+
+    def release(self):
+        self._mutex.acquire()
+        try:
+            if self._writer is not None and self._writer == get_ident():
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._condition.notifyAll()
+            elif self._readers:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notifyAll()
+            else:
+                raise ValueError("Trying to release unheld lock")
+        finally:
+            self._mutex.release()
+
+    def read(self):
+        return self._read
+
+    def write(self):
+        return self._write
+
+
+class PhaseFairLock(object):
+    # Read and write phases alternate. A reader that arrives while a writer
+    # holds or waits for the lock waits for the end of one write phase at
+    # most, as the writer that ends it lets all waiting readers in at once.
+    # Writers take turns in arrival order and wait for the readers of the
+    # current read phase to leave. Neither side can starve the other.
+    #
+    # A reader that nests read locks while a writer is waiting deadlocks,
+    # since the writer waits for it and it waits for the writer; use
+    # CountingLock or ReadWriteLock where read locks nest.
+    def __init__(self):
+        self._mutex = Lock()
+        self._condition = Condition(self._mutex)
+        self._readers = 0
+        self._waiting_readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting_writers = 0
+        # Tickets, to let writers in in arrival order
+        self._next_ticket = 0
+        self._serving = 0
+        # Moves on whenever a write phase ends
+        self._phase = 0
+        self._read = _Section(self.acquireRead, self.release)
+        self._write = _Section(self.acquireWrite, self.release)
+
+    def acquireRead(self):
+        self._mutex.acquire()
+        try:
+            if self._writer is None and not self._waiting_writers:
+                self._readers += 1
+                return
+            if self._writer == get_ident():
+                self._depth += 1
+                return
+            # The writer ending this phase counts us in
+            self._waiting_readers += 1
+            phase = self._phase
+            while self._phase == phase:
+                self._condition.wait()
+        finally:
+            self._mutex.release()
+
+    def acquireWrite(self):
+        me = get_ident()
+        self._mutex.acquire()
+        try:
+            if self._writer == me:
+                self._depth += 1
+                return
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers or self._serving != ticket:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._depth = 1
+        finally:
+            self._mutex.release()
+
+    def release(self):
+        self._mutex.acquire()
+        try:
+            if self._writer is not None and self._writer == get_ident():
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._serving += 1
+                    if self._waiting_readers:
+                        self._readers += self._waiting_readers
+                        self._waiting_readers = 0
+                        self._phase += 1
+                    self._condition.notifyAll()
+            elif self._readers:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notifyAll()
+            else:
+                raise ValueError("Trying to release unheld lock")
+        finally:
+            self._mutex.release()
+
+    def read(self):
+        return self._read
+
+    def write(self):
+        return self._write
@@ -3,6 +3,7 @@ __author__ = 'wynand'
 from nose.tools import raises
 import hierarchy
 import multimethod
+import methodcache
 
 
 def test_basic():
@@ -131,3 +132,1304 @@ def test_add_new_base():
     assert swim('cuttlefish') == 'cuttlefish is swimming'
     assert swim('octopus') == 'octopus is swimming'
 
+
+
+def test_bounded_cache():
+    evicted = []
+    h = hierarchy.Hierarchy()
+    h.derive({'number': {'even': None, 'odd': None}})
+
+    @h.multimethod(lambda x: x[0], cache=methodcache.LRUCache(2, on_evict=lambda k, v: evicted.append(k)))
+    def parity(x):
+        return 'unknown'
+
+    @parity.add_method('number')
+    def parity(x):
+        return 'number'
+
+    assert parity(('even',)) == 'number'
+    assert parity(('odd',)) == 'number'
+    assert parity(('even',)) == 'number'
+    assert parity(('number',)) == 'number'
+    assert evicted == ['odd']
+    assert sorted(parity.method_cache.keys()) == ['even', 'number']
+    assert parity.method_cache.evictions == 1
+
+    # A cache passed to several multimethods is a template for each
+    cache = methodcache.LRUCache(2)
+    first = multimethod.MultiMethod('first', lambda x: x, hierarchy=h, default_func=lambda x: 'first', cache=cache)
+    second = multimethod.MultiMethod('second', lambda x: x, hierarchy=h, default_func=lambda x: 'second', cache=cache)
+    assert first.method_cache is not second.method_cache
+    assert isinstance(second.method_cache, methodcache.LRUCache)
+    assert (first('even'), second('even')) == ('first', 'second')
+
+
+def test_cache_policies():
+    lfu = methodcache.LFUCache(2)
+    lfu['a'] = 1
+    lfu['b'] = 2
+    lfu.get('a')
+    lfu['c'] = 3
+    assert sorted(lfu.keys()) == ['a', 'c']
+
+    arc = methodcache.ARCCache(2)
+    arc['a'] = 1
+    arc.get('a')
+    for key in 'bcd':
+        arc[key] = key
+    # 'a' was used twice, so it survives the stream of one-off entries
+    assert 'a' in arc and len(arc) == 2
+    assert arc.evictions == 2
+
+
+def test_factored_dispatch():
+    h = hierarchy.Hierarchy()
+    colours = ['red', 'green', 'blue', 'cyan', 'magenta']
+    shapes = ['circle', 'square', 'triangle', 'hexagon']
+    for colour in colours:
+        h.derive(colour, 'colour')
+    for shape in shapes:
+        h.derive(shape, 'shape')
+
+    @h.multimethod(lambda c, s: (c, s), factored=True)
+    def draw(c, s):
+        return 'default'
+
+    @draw.add_method(('colour', 'shape'))
+    def draw(c, s):
+        return 'any'
+
+    @draw.add_method(('red', 'shape'))
+    def draw(c, s):
+        return 'red'
+
+    @draw.add_method(('colour', 'square'))
+    def draw(c, s):
+        return 'square'
+
+    draw.prefer_method(('red', 'shape'), ('colour', 'square'))
+
+    for colour in colours:
+        for shape in shapes:
+            expected = 'red' if colour == 'red' else 'square' if shape == 'square' else 'any'
+            assert draw(colour, shape) == expected
+    assert draw('shape', 'colour') == 'default'
+
+    index = draw.factored_index
+    assert len(index.component_matches) == len(colours) + len(shapes) + 1
+    assert len(index.methods) == 5
+    assert len(draw.method_cache) == 0
+
+
+@raises(multimethod.ArgumentConflict)
+def test_factored_ambiguous():
+    bar = make_disambiguation_method()
+    bar.factored = True
+    bar('rect', 'rect')
+
+
+def test_copy_on_write():
+    h = hierarchy.Hierarchy(copy_on_write=True)
+    h.derive('rect', 'shape')
+
+    @h.multimethod()
+    def area(x):
+        return 'unknown'
+
+    assert area.copy_on_write
+    assert area('rect') == 'unknown'
+
+    @area.add_method('shape')
+    def area(x):
+        return 'shape'
+
+    assert area('rect') == 'shape'
+    snapshot = area.snapshot
+    h.derive('square', 'rect')
+    assert area('square') == 'shape'
+    # The old snapshot still describes the hierarchy as it was
+    assert area.snapshot is not snapshot
+    assert snapshot.get_method('square')('square') == 'unknown'
+
+    area.remove_method('shape')
+    assert area('square') == 'unknown'
+
+
+@raises(ValueError)
+def test_copy_on_write_needs_hierarchy_support():
+    h = hierarchy.Hierarchy()
+    multimethod.MultiMethod('foo', lambda x: x, hierarchy=h, copy_on_write=True)
+
+
+def make_animal_method(h):
+    h.derive({
+        'animal': {
+            'mammal': {'dog': None, 'cat': None},
+            'fish': {'trout': None}
+        }
+    })
+
+    @h.multimethod()
+    def speak(x):
+        return 'silence'
+
+    @speak.add_method('mammal')
+    def speak(x):
+        return 'noise'
+
+    @speak.add_method('fish')
+    def speak(x):
+        return 'blub'
+
+    @speak.add_method(('mammal', 'mammal'))
+    def speak(x):
+        return 'fight'
+
+    for animal in ['dog', 'cat', 'trout', ('dog', 'cat')]:
+        speak(animal)
+    return speak
+
+
+def test_selective_invalidation():
+    for copy_on_write in (False, True):
+        h = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+        speak = make_animal_method(h)
+
+        h.derive('puppy', 'dog')
+        assert speak('puppy') == 'noise'
+        assert set(speak.method_cache.keys()) == {'dog', 'cat', 'trout', ('dog', 'cat'), 'puppy'}
+
+        @speak.add_method('dog')
+        def speak(x):
+            return 'woof'
+
+        # Only the dog and its descendants had to go
+        assert set(speak.method_cache.keys()) == {'cat', 'trout', ('dog', 'cat')}
+        assert speak('puppy') == 'woof'
+
+        h.derive('cat', 'pet')
+        # The hierarchy is caught up with on the next call
+        assert speak('trout') == 'blub'
+        assert set(speak.method_cache.keys()) == {'trout', 'puppy'}
+        assert speak('cat') == 'noise'
+
+        speak.remove_method('mammal')
+        assert set(speak.method_cache.keys()) == {'trout'}
+        assert speak('cat') == 'silence'
+        assert speak('puppy') == 'woof'
+
+
+def test_late_derivation_reaches_descendants():
+    h = hierarchy.Hierarchy()
+    h.derive('puppy', 'dog')
+    h.derive('mammal', 'animal')
+    h.derive('dog', 'mammal')
+    assert h.is_a('puppy', 'animal')
+
+
+def test_compact_hierarchy():
+    h = hierarchy.CompactHierarchy()
+    h.derive({'shape': {'rect': {'square': None}, 'ellipse': {'circle': None}}})
+    h.derive('square', 'regular')
+    assert h.is_a('square', 'shape')
+    assert h.is_a('square', 'regular')
+    assert not h.is_a('circle', 'rect')
+    assert h.ancestors['square'] == {'square', 'rect', 'shape', 'regular'}
+    assert h.is_a(('square', 'circle'), ('rect', 'shape'))
+
+    @raises(hierarchy.CircularRelationship)
+    def derive_circle():
+        h.derive('shape', 'circle')
+    derive_circle()
+
+    found = h.is_a_many(['square', 'circle', 'circle', 'unknown', ('square',), bool],
+                        ['shape', 'rect', 'circle', 'shape', ('rect',), int])
+    assert found.tolist() == [True, False, True, False, True, True]
+    assert h.is_a_many(['square', 'unknown'], [multimethod.ANY] * 2).tolist() == [True, True]
+
+    @h.multimethod()
+    def sides(x):
+        return None
+
+    @sides.add_method('rect')
+    def sides(x):
+        return 4
+
+    assert sides('square') == 4
+    assert sides('circle') is None
+
+
+def test_ancestor_lookup():
+    import collections
+
+    class Base(object):
+        pass
+
+    class Derived(Base):
+        pass
+
+    h = hierarchy.Hierarchy()
+    h.derive('b', 'a')
+    h.derive(Derived, 'a')
+
+    @h.multimethod()
+    def describe(x):
+        return 'default'
+
+    @describe.add_method(collections.Sized)
+    def describe(x):
+        return 'sized'
+
+    @describe.add_method(Base)
+    def describe(x):
+        return 'base'
+
+    @describe.add_method('a')
+    def describe(x):
+        return 'a'
+
+    @describe.add_method(('a', Base))
+    def describe(x):
+        return 'a and base'
+
+    assert describe('b') == 'a'
+    # Known to the hierarchy, so only its ancestors count
+    assert describe(Derived) == 'a'
+    # Found through the __mro__ and the abstract base classes
+    assert describe(type('Other', (Base,), {})) == 'base'
+    assert describe(list) == 'sized'
+    assert describe(int) == 'default'
+    assert describe(('b', Base)) == 'a and base'
+
+    @raises(multimethod.ArgumentConflict)
+    def conflict():
+        describe(type('Both', (Base, collections.Sized), {'__len__': lambda self: 0}))
+    conflict()
+
+
+def test_map():
+    import itertools
+    import numpy
+
+    h = hierarchy.Hierarchy()
+    h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+    calls = []
+
+    def shape_type(s):
+        calls.append(s)
+        return s['type']
+
+    @h.multimethod(shape_type)
+    def sides(s):
+        return None
+
+    @sides.add_method('rect')
+    def sides(s):
+        return 4
+
+    records = [{'type': t} for t in ['square', 'circle', 'rect', 'square', 'shape']]
+    assert sides.map(records, chunksize=2) == [4, None, 4, 4, None]
+    assert len(calls) == 5
+
+    # Records resolve once per distinct dispatch value and chunk
+    resolved = []
+    get_method = sides.get_method
+    sides.get_method = lambda dispatch_val: resolved.append(dispatch_val) or get_method(dispatch_val)
+    labels = ['square', 'circle']
+    codes = numpy.array([0, 1, 0, 0, 1, 1], dtype=numpy.int8)
+    assert sides.map(range(6), codes, labels, chunksize=4) == [4, None, 4, 4, None, None]
+    assert resolved == ['square', 'circle', 'circle']
+
+    # The records and dispatch values can be unbounded generators
+    squares = itertools.repeat({'type': 'square'})
+    assert list(itertools.islice(sides.imap(squares, itertools.repeat('square')), 3)) == [4, 4, 4]
+
+
+def test_seal():
+    h = hierarchy.Hierarchy()
+    h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+    @h.multimethod(lambda a, b: (a, b))
+    def overlap(a, b):
+        return 'maybe'
+
+    @overlap.add_method(('rect', 'rect'))
+    def overlap(a, b):
+        return 'rects'
+
+    @overlap.add_method(('square', 'shape'))
+    def overlap(a, b):
+        return 'square first'
+
+    @raises(ValueError)
+    def seal_unfrozen():
+        overlap.seal()
+    seal_unfrozen()
+
+    h.freeze()
+    overlap.seal()
+    assert overlap.sealed_methods[('square', 'circle')] is overlap.method_table[('square', 'shape')]
+    assert ('circle', 'circle') not in overlap.sealed_methods
+    assert overlap('circle', 'circle') == 'maybe'
+    assert overlap('rect', 'square') == 'rects'
+
+    # Ambiguous values are left out, to raise as before
+    assert ('square', 'square') not in overlap.sealed_methods
+
+    @raises(multimethod.ArgumentConflict)
+    def ambiguous():
+        overlap('square', 'square')
+    ambiguous()
+
+    @raises(hierarchy.HierarchyFrozen)
+    def derive():
+        h.derive('triangle', 'shape')
+    derive()
+
+    @raises(multimethod.MultiMethodSealed)
+    def add_method():
+        overlap.add_method(('circle', 'circle'))(lambda a, b: 'circles')
+    add_method()
+
+
+def test_batch():
+    h = hierarchy.Hierarchy()
+    h.derive('mammal', 'animal')
+    version = h.__version__
+    with h.batch():
+        h.derive('puppy', 'dog')
+        h.derive({'mammal': {'dog': None, 'cat': None}})
+        # Nothing shows until the batch is done
+        assert 'puppy' not in h.ancestors
+    assert h.__version__ == version + 1
+    assert h.is_a('puppy', 'animal')
+    assert h.is_a('cat', 'mammal')
+
+    @raises(hierarchy.CircularRelationship)
+    def cycle():
+        with h.batch():
+            h.derive('kitten', 'cat')
+            h.derive('animal', 'kitten')
+    cycle()
+    assert 'kitten' not in h.ancestors
+    assert h.__version__ == version + 1
+
+    @h.multimethod()
+    def speak(x):
+        return 'silence'
+
+    speak.add_method('animal')(lambda x: 'noise')
+    assert speak('dog') == 'noise'
+    with speak.batch():
+        speak.add_method('dog')(lambda x: 'woof')
+        speak.add_method('cat')(lambda x: 'meow')
+        # The cache only catches up once the batch is done
+        assert 'dog' in speak.method_cache
+    assert 'dog' not in speak.method_cache
+    assert speak('puppy') == 'woof'
+    assert speak('cat') == 'meow'
+
+    @raises(ValueError)
+    def fail():
+        with speak.batch():
+            speak.remove_method('animal')
+            raise ValueError()
+    fail()
+    assert 'animal' in speak.method_table
+    assert speak('mammal') == 'noise'
+
+    # Misses within a batch see its changes so far
+    h.derive('tabby', 'cat')
+    with speak.batch():
+        speak.remove_method('cat')
+        assert speak('tabby') == 'noise'
+
+    # Nor does anything resolved within a batch that raises outlive it
+    h.derive('horse', 'mammal')
+
+    @raises(ValueError)
+    def rollback():
+        with speak.batch():
+            speak.add_method('mammal')(lambda x: 'neigh')
+            assert speak('horse') == 'neigh'
+            raise ValueError()
+    rollback()
+    assert speak('horse') == 'noise'
+
+    @raises(ValueError)
+    def rollback_removal():
+        with speak.batch():
+            speak.remove_method('dog')
+            assert speak('puppy') == 'noise'
+            raise ValueError()
+    rollback_removal()
+    assert speak('puppy') == 'woof'
+
+    @h.multimethod(lambda a, b: (a, b), factored=True)
+    def meet(a, b):
+        return 'ignore'
+
+    meet.add_method(('dog', 'cat'))(lambda a, b: 'chase')
+    meet.add_method(('animal', 'animal'))(lambda a, b: 'sniff')
+    assert meet('puppy', 'cat') == 'chase'
+    with meet.batch():
+        meet.remove_method(('dog', 'cat'))
+        assert meet('dog', 'cat') == 'sniff'
+
+    @raises(ValueError)
+    def rollback_factored():
+        with meet.batch():
+            meet.remove_method(('animal', 'animal'))
+            assert meet('dog', 'dog') == 'ignore'
+            raise ValueError()
+    rollback_factored()
+    assert meet('dog', 'dog') == 'sniff'
+
+
+def test_from_edges():
+    import os
+    import shutil
+    import tempfile
+
+    for cls in (hierarchy.Hierarchy, hierarchy.CompactHierarchy):
+        # Deep enough to have blown the stack when ancestors were passed on recursively
+        h = cls()
+        for i in xrange(1, 3000):
+            h.derive(i, i - 1)
+        h.derive(0, 'root')
+        assert h.is_a(2999, 'root')
+
+        edges = [('square', 'rect'), ('rect', 'shape'), ('square', 'regular'), ('rect', 'shape')]
+        h = cls.from_edges(edges)
+        assert h.is_a('square', 'shape')
+        assert h.is_a('square', 'regular')
+        assert not h.is_a('rect', 'regular')
+
+        @raises(hierarchy.CircularRelationship)
+        def cycle():
+            cls.from_edges(edges + [('shape', 'square')])
+        cycle()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'edges.csv')
+        with open(path, 'w') as f:
+            f.write('square,rect\nrect,shape\n')
+        assert hierarchy.Hierarchy.load(path).is_a('square', 'shape')
+
+        path = os.path.join(directory, 'edges.jsonl')
+        with open(path, 'w') as f:
+            f.write('["square", "rect"]\n{"child": "rect", "parent": "shape"}\n\n')
+        assert hierarchy.CompactHierarchy.load(path).is_a('square', 'shape')
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_metrics():
+    for copy_on_write in (False, True):
+        h = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+        h.derive('puppy', 'dog')
+        events = []
+        hierarchy_metrics = h.enable_metrics()
+
+        @h.multimethod()
+        def speak(x):
+            return 'noise'
+
+        speak.add_method('dog')(lambda x: 'woof')
+        recorder = speak.enable_metrics(lambda name, value: events.append(name))
+        assert speak.enable_metrics() is recorder
+
+        for animal in ['dog', 'puppy', 'dog', 'puppy', 'dog']:
+            assert speak(animal) == 'woof'
+        stats = recorder.snapshot()
+        assert (stats['calls'], stats['hits'], stats['misses']) == (5, 3, 2)
+        assert stats['resolution']['count'] == 2
+        assert stats['cache_size'] == 2
+        assert events.count('miss') == 2
+
+        speak.add_method('puppy')(lambda x: 'yap')
+        assert recorder.snapshot()['invalidations']['add_method'] == {'count': 1, 'entries': 1}
+        h.derive('dog', 'animal')
+        assert speak('dog') == 'woof'
+        assert recorder.snapshot()['invalidations']['hierarchy']['entries'] == 1
+        assert hierarchy_metrics.snapshot()['invalidations']['derive'] == {'count': 1, 'entries': 2}
+        assert recorder.snapshot()['lock_hold']['write']['count'] > 0
+
+        speak.disable_metrics()
+        h.disable_metrics()
+        assert speak.metrics is None
+        assert isinstance(speak.rw, multimethod.rwlock.ReadWriteLock)
+        assert speak('puppy') == 'yap'
+        assert recorder.snapshot()['calls'] == 6
+
+
+def test_async_multimethod():
+    import os
+    import threading
+    try:
+        import trollius
+        from trollius import From, Return
+    except ImportError:
+        from nose.plugins.skip import SkipTest
+        raise SkipTest("trollius is not installed")
+    import asyncmultimethod
+
+    h = hierarchy.Hierarchy(copy_on_write=True)
+    h.derive('puppy', 'dog')
+
+    @trollius.coroutine
+    def animal_type(animal):
+        yield From(trollius.sleep(0))
+        raise Return(animal['type'])
+
+    @h.async_multimethod(animal_type)
+    def speak(animal):
+        return 'noise'
+
+    @trollius.coroutine
+    def woof(animal):
+        yield From(trollius.sleep(0))
+        raise Return('woof')
+
+    speak.add_method('dog')(woof)
+
+    resolved = []
+    get_method = speak.get_method
+    speak.get_method = lambda dispatch_val: resolved.append(dispatch_val) or get_method(dispatch_val)
+
+    loop = trollius.new_event_loop()
+    trollius.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(trollius.gather(*[speak({'type': 'puppy'}) for _ in xrange(5)], loop=loop))
+        assert results == ['woof'] * 5
+        # Resolved once for all five, and taken from the cache from then on
+        assert resolved == ['puppy']
+        assert loop.run_until_complete(speak({'type': 'puppy'})) == 'woof'
+        assert resolved == ['puppy']
+
+        loop.run_until_complete(speak.add_method_async('puppy', lambda animal: 'yap'))
+        loop.run_until_complete(asyncmultimethod.derive_async(h, 'cat', 'animal'))
+        assert loop.run_until_complete(speak({'type': 'puppy'})) == 'yap'
+        assert loop.run_until_complete(speak({'type': 'cat'})) == 'noise'
+        # The default method is cached too
+        assert loop.run_until_complete(speak({'type': 'cat'})) == 'noise'
+        assert resolved.count('cat') == 1
+
+        # Lazy methods are imported in the executor, not on the loop
+        imported = []
+        speak.add_lazy_method('cat', 'os.path:join')
+        lazy = speak.method_table['cat']
+        load = lazy.load
+        lazy.load = lambda: imported.append(threading.current_thread()) or load()
+        assert loop.run_until_complete(speak.get_method_async('cat')) is os.path.join
+        assert imported and threading.current_thread() not in imported
+    finally:
+        trollius.set_event_loop(None)
+        loop.close()
+
+
+def test_dispatch_image():
+    import os
+    import shutil
+    import tempfile
+    import dispatchimage
+
+    def make():
+        h = hierarchy.Hierarchy()
+        h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+        @h.multimethod()
+        def sides(s):
+            return None
+
+        sides.add_method('rect')(lambda s: 4)
+
+        @h.multimethod(lambda a, b: (a, b))
+        def overlap(a, b):
+            return 'maybe'
+
+        overlap.add_method(('rect', 'rect'))(lambda a, b: 'rects')
+        return h, sides, overlap
+
+    h, sides, overlap = make()
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'dispatch.image')
+        dispatchimage.write(path, h, [sides, overlap])
+
+        # As a worker would: same registrations, but no hierarchy to speak
+        # of, as the image stands in for it
+        image = dispatchimage.DispatchImage.open(path)
+        worker = hierarchy.Hierarchy()
+
+        @worker.multimethod()
+        def sides(s):
+            return None
+
+        sides.add_method('rect')(lambda s: 4)
+        image.bind(sides)
+        assert sides('square') == 4
+        assert sides('circle') is None
+        assert sides(u'square') == 4
+        assert image.is_a('square', 'shape')
+        assert not image.is_a('circle', 'rect')
+        assert image.ancestors('square') == {'square', 'rect', 'shape'}
+        assert image.resolved_key('overlap', ('square', 'rect')) == (True, ('rect', 'rect'))
+        assert image.resolved_key('overlap', ('rect', 'square')) == (True, ('rect', 'rect'))
+        assert image.resolved_key('overlap', 'circle') == (True, None)
+        # No tuple key could ever match, so it is not in the image
+        assert image.resolved_key('overlap', ('circle', 'rect')) == (False, None)
+        assert image.resolved_key('overlap', ('triangle', 'rect')) == (False, None)
+
+        # Unknown to the image, so up to the worker's own hierarchy
+        worker.derive('rhombus', 'rect')
+        assert sides('rhombus') == 4
+
+        # Changes after binding are not lost on the image, copy on write or
+        # not, and with or without a hierarchy
+        for copy_on_write, populated in ((False, True), (True, True), (False, False)):
+            worker = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+            if populated:
+                worker.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+            @worker.multimethod(cache=methodcache.LRUCache(2))
+            def sides(s):
+                return None
+
+            sides.add_method('rect')(lambda s: 4)
+            image.bind(sides)
+            for shape in ('square', 'rect', 'circle', 'square'):
+                sides(shape)
+            assert sides('square') == 4
+            # What it finds in the image is kept as the multimethod's cache would be
+            assert len(sides._inline_caches[-1]) == 2
+            sides.add_method('circle')(lambda s: 0)
+            assert sides('circle') == 0
+            sides.add_method('shape')(lambda s: 'some')
+            assert sides('square') == 4
+            sides.remove_method('rect')
+            assert sides('square') == 'some'
+        image.close()
+
+        # Tuples left out of the image for want of room are resolved against
+        # it all the same
+        h, sides, overlap = make()
+        dispatchimage.write(path, h, [sides, overlap], max_entries=5)
+        image = dispatchimage.DispatchImage.open(path)
+        assert image.resolved_key('overlap', ('square', 'square')) == (False, None)
+        assert overlap('square', 'square') == 'rects'
+        worker = hierarchy.Hierarchy()
+
+        @worker.multimethod(lambda a, b: (a, b))
+        def overlap(a, b):
+            return 'maybe'
+
+        overlap.add_method(('rect', 'rect'))(lambda a, b: 'rects')
+        image.bind(overlap)
+        assert overlap('square', 'square') == 'rects'
+        assert overlap('square', 'circle') == 'maybe'
+        image.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_warmup():
+    import os
+    import shutil
+    import tempfile
+    import warmup
+
+    def make(copy_on_write=False):
+        h = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+        h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+        @h.multimethod()
+        def area(s):
+            return None
+
+        area.add_method('shape')(lambda s: 'shape')
+        area.add_method('rect')(lambda s: 'rect')
+        return h, area
+
+    h, area = make()
+    for shape in ('square', 'circle', 'rect'):
+        area(shape)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'area.profile')
+        profile = warmup.save(path, [area])
+        assert sorted(profile.entries['area']) == [('circle', 'shape'), ('rect', 'rect'), ('square', 'rect')]
+
+        # After a restart, with a new method in the meantime
+        for copy_on_write in (False, True):
+            h, area = make(copy_on_write)
+            area.add_method('square')(lambda s: 'square')
+            result = warmup.warm(path, [area])
+            assert result['warmed'] == 3
+            assert result['stale'] == [('area', 'square')]
+            assert sorted(area.method_cache.keys()) == ['circle', 'rect', 'square']
+            assert area('square') == 'square'
+
+        h, area = make()
+        results = []
+        warmup.warm_in_background(warmup.Profile.load(path), [area], results.append).join()
+        assert results[0] == {'warmed': 3, 'stale': []}
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_type_dispatch():
+    import gc
+    import weakref
+    from abc import ABCMeta
+
+    h = hierarchy.Hierarchy()
+
+    class Animal(object):
+        pass
+
+    class Dog(Animal):
+        pass
+
+    class Robot(object):
+        pass
+
+    class RoboDog(Dog, Robot):
+        pass
+
+    # Derivations count along with the __mro__
+    h.derive(Robot, 'machine')
+
+    @h.multimethod(type, type_dispatch=True)
+    def describe(x):
+        return 'thing'
+
+    describe.add_method(Animal)(lambda x: 'animal')
+    describe.add_method('machine')(lambda x: 'machine')
+    assert describe(Dog()) == 'animal'
+    assert describe(Robot()) == 'machine'
+    assert describe(3) == 'thing'
+    try:
+        describe(RoboDog())
+        assert False
+    except multimethod.ArgumentConflict:
+        pass
+    describe.prefer_method(Animal, 'machine')
+    assert describe(RoboDog()) == 'animal'
+    assert RoboDog in describe.type_cache
+
+    # Changes to the hierarchy or the method table reach the cached classes
+    class Toaster(object):
+        pass
+
+    assert describe(Toaster()) == 'thing'
+    h.derive(Toaster, 'machine')
+    assert describe(Toaster()) == 'machine'
+    describe.add_method(Dog)(lambda x: 'dog')
+    assert describe(Dog()) == 'dog'
+
+    # As does registering a class with an ABC
+    class Pet(object):
+        __metaclass__ = ABCMeta
+
+    describe.add_method(Pet)(lambda x: 'pet')
+
+    class Cat(object):
+        pass
+
+    assert describe(Cat()) == 'thing'
+    Pet.register(Cat)
+    assert describe(Cat()) == 'pet'
+
+    # Classes that come and go are not kept alive by the cache
+    def make_class():
+        class Temporary(Animal):
+            pass
+        assert describe(Temporary()) == 'animal'
+        return weakref.ref(Temporary)
+
+    temporary = make_class()
+    gc.collect()
+    assert temporary() is None
+    assert len([cls for cls in describe.type_cache.keys() if cls.__name__ == 'Temporary']) == 0
+
+    # Precomputed classes go to type_cache too
+    assert Robot not in describe.type_cache
+    describe.precompute()
+    assert Robot in describe.type_cache
+    assert not [value for value in describe.method_cache if isinstance(value, type)]
+
+
+def test_specialize():
+    for copy_on_write in (False, True):
+        h = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+        h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+        @h.multimethod(lambda a, b: (a, b))
+        def combine(a, b):
+            return 'default'
+
+        combine.add_method(('shape', 'shape'))(lambda a, b: 'shapes')
+        call = combine.specialize(inline_cache_size=2)
+        assert call.__name__ == 'combine'
+        assert call('square', 'circle') == 'shapes'
+        assert call('square', 'circle') == 'shapes'
+        assert call('line', 'circle') == 'default'
+        assert call('rect', 'rect') == 'shapes'
+
+        # Changes to the tables and the hierarchy reach the inline cache
+        combine.add_method(('rect', 'shape'))(lambda a, b: 'rect and shape')
+        assert call('square', 'circle') == 'rect and shape'
+        h.derive('line', 'shape')
+        assert call('line', 'circle') == 'shapes'
+        with combine.batch():
+            combine.remove_method(('rect', 'shape'))
+        assert call('square', 'circle') == 'shapes'
+
+    # Without a fixed arity
+    @h.multimethod(lambda *args: args[0])
+    def first(*args):
+        return args
+
+    first.add_method('rect')(lambda *args: 'rect')
+    call = first.specialize()
+    assert call('square', 1) == 'rect'
+    assert call('line', 1) == ('line', 1)
+
+
+def test_locks():
+    import threading
+    from rwlock import CountingLock, NullLock, PhaseFairLock
+
+    for lock in (CountingLock, NullLock, PhaseFairLock):
+        h = hierarchy.Hierarchy(lock=lock())
+        h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+        @h.multimethod(lock=lock())
+        def sides(s):
+            return None
+
+        assert isinstance(h.rw, lock) and isinstance(sides.rw, lock)
+        # Batches nest write locks, and take read locks inside them
+        with sides.batch():
+            sides.add_method('rect')(lambda s: 4)
+            sides.add_method('circle')(lambda s: 0)
+        with h.batch():
+            h.derive('rhombus', 'shape')
+        assert sides('square') == 4
+        assert sides('rhombus') is None
+
+    for lock in (CountingLock(), PhaseFairLock()):
+        counter = [0]
+
+        def work():
+            for _ in xrange(200):
+                with lock.write():
+                    with lock.read():
+                        value = counter[0]
+                    counter[0] = value + 1
+                with lock.read():
+                    pass
+
+        threads = [threading.Thread(target=work) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counter[0] == 800
+
+    @raises(ValueError)
+    def release_unheld():
+        CountingLock().release()
+
+    release_unheld()
+
+
+def test_wildcards():
+    from dispatchindex import compile_matcher
+    from multimethod import ANY
+
+    for factored in (False, True):
+        h = hierarchy.Hierarchy()
+        h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+        @h.multimethod(lambda a, b: (a, b), factored=factored)
+        def collide(a, b):
+            return 'default'
+
+        collide.add_method(('rect', ANY))(lambda a, b: 'rect with anything')
+        collide.add_method(('rect', 'circle'))(lambda a, b: 'rect with circle')
+        collide.add_method((ANY, 'square'))(lambda a, b: 'anything with square')
+        assert collide('square', 'line') == 'rect with anything'
+        assert collide('square', 'circle') == 'rect with circle'
+        assert collide('circle', 'square') == 'anything with square'
+        assert collide('circle', 'circle') == 'default'
+        try:
+            collide('square', 'square')
+            assert False
+        except multimethod.ArgumentConflict:
+            pass
+        collide.prefer_method(('rect', ANY), (ANY, 'square'))
+        assert collide('square', 'square') == 'rect with anything'
+        assert h.is_a(('square', 'line'), ('rect', ANY))
+        assert not h.is_a(('rect', ANY), ('square', 'line'))
+
+        # A bare ANY matches everything, however it is dispatched
+        collide.add_method(ANY)(lambda a, b: 'anything')
+        assert collide('circle', 'circle') == 'anything'
+        assert collide('x', 'y') == 'anything'
+        assert collide('square', 'circle') == 'rect with circle'
+
+    @h.multimethod(type, type_dispatch=True)
+    def describe(x):
+        return 'thing'
+
+    describe.add_method(ANY)(lambda x: 'anything')
+    describe.add_method(int)(lambda x: 'int')
+    assert describe('x') == 'anything'
+    assert describe(3) == 'int'
+
+    # Matchers agree with is_a
+    for key in (('rect', ANY), ('shape', 'circle'), 'rect', (('rect', ANY), 'shape')):
+        matches = compile_matcher(key)
+        for value in ('square', ('square', 'circle'), ('circle', 'square'), ('square',), (('square', 1), 'rect')):
+            assert matches(h, value) == h.is_a(value, key), (key, value)
+
+
+def test_precompute():
+    for factored, copy_on_write in ((False, False), (True, False), (False, True)):
+        h = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+        h.derive({'shape': {'rect': {'square': None}, 'circle': None}, 'line': None})
+        h.derive('square', 'polygon')
+
+        @h.multimethod(lambda a, b: (a, b), factored=factored)
+        def collide(a, b):
+            return 'default'
+
+        collide.add_method(('rect', 'shape'))(lambda a, b: 'rect with shape')
+        collide.add_method(('polygon', 'shape'))(lambda a, b: 'polygon with shape')
+        # Tuples that do not fit are reported rather than vouched for
+        report = collide.precompute(max_entries=10)
+        assert report['ambiguous'] == {}
+        assert report['skipped'] == {2: 12}
+        report = collide.precompute()
+        assert report['skipped'] == {}
+        assert report['unhandled'] == []
+        pairs = report['ambiguous']
+        assert pairs.keys() in ([(('rect', 'shape'), ('polygon', 'shape'))],
+                                [(('polygon', 'shape'), ('rect', 'shape'))]), pairs
+        assert sorted(pairs.values()[0]) == [('square', 'circle'), ('square', 'rect'),
+                                             ('square', 'shape'), ('square', 'square')]
+
+        collide.prefer_method(('rect', 'shape'), ('polygon', 'shape'))
+        report = collide.precompute()
+        assert report['ambiguous'] == {}
+        assert (report['resolved'], report['default']) == (12, 5)
+        if not factored and not copy_on_write:
+            assert collide.method_cache[('square', 'circle')] is collide.method_table[('rect', 'shape')]
+        assert collide('square', 'circle') == 'rect with shape'
+        assert collide('line', 'circle') == 'default'
+
+    # Without a default method, values that go nowhere are reported
+    @h.multimethod()
+    def area(shape):
+        pass
+
+    area.remove_method(multimethod.DefaultDispatchValue)
+    area.add_method('rect')(lambda shape: 'rect')
+    report = area.precompute()
+    assert sorted(report['unhandled']) == ['circle', 'polygon', 'shape']
+    assert report['resolved'] == 2
+
+
+def test_default_caching():
+    for copy_on_write, type_dispatch in ((False, False), (True, False), (False, True)):
+        h = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+        h.derive('dog', 'animal')
+
+        @h.multimethod(type_dispatch=type_dispatch)
+        def speak(animal):
+            return 'noise'
+
+        speak.add_method('animal')(lambda animal: 'grunt')
+        assert speak('rock') == 'noise'
+        assert 'rock' in speak.method_cache
+        assert speak('rock') == 'noise'
+
+        # Whatever the default method is at the time of the call
+        speak.add_method(multimethod.DefaultDispatchValue)(lambda animal: 'silence')
+        assert speak('rock') == 'silence'
+        speak.remove_method(multimethod.DefaultDispatchValue)
+
+        @raises(NotImplementedError)
+        def unhandled():
+            speak('rock')
+
+        unhandled()
+        unhandled()
+
+        # Evicted like any other entry
+        h.derive('rock', 'animal')
+        assert speak('rock') == 'grunt'
+        h.derive('tree', 'plant')
+        speak.add_method(multimethod.DefaultDispatchValue)(lambda animal: 'noise')
+        assert speak('tree') == 'noise'
+        speak.add_method('plant')(lambda animal: 'rustle')
+        assert 'tree' not in speak.method_cache
+        assert speak('tree') == 'rustle'
+
+    class Rock(object):
+        pass
+
+    assert speak(Rock) == 'noise'
+    assert Rock in speak.type_cache
+    speak.add_method(Rock)(lambda animal: 'rock')
+    assert speak(Rock) == 'rock'
+
+
+def test_single_flight():
+    import threading
+    import time
+
+    h = hierarchy.Hierarchy()
+    h.derive('dog', 'animal')
+
+    @h.multimethod()
+    def speak(animal):
+        return 'noise'
+
+    speak.add_method('animal')(lambda animal: 'grunt')
+    resolved = []
+    resolve = speak._resolve_and_cache
+
+    def slow_resolve(dispatch_val):
+        resolved.append(dispatch_val)
+        time.sleep(0.02)
+        return resolve(dispatch_val)
+
+    speak._resolve_and_cache = slow_resolve
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(speak('dog'))) for _ in xrange(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['grunt'] * 8
+    # One of them resolved it, the others shared its result
+    assert resolved == ['dog']
+    del speak._resolve_and_cache
+
+    # Tables that keep changing do not keep resolution going forever
+    select_best_method = speak._select_best_method
+    attempts = []
+
+    def changing(dispatch_val, matches):
+        attempts.append(dispatch_val)
+        speak.prefer_table.__version__ += 1
+        return select_best_method(dispatch_val, matches)
+
+    speak._select_best_method = changing
+    assert speak('animal') == 'grunt'
+    assert len(attempts) == multimethod._MAX_RESOLVE_ATTEMPTS + 1
+    assert speak.method_cache['animal'] is speak.method_table['animal']
+
+
+def test_rewarming():
+    import time
+    from rwlock import NullLock
+
+    h = hierarchy.Hierarchy()
+    h.derive('dog', 'animal')
+    h.derive('cat', 'animal')
+
+    @h.multimethod()
+    def speak(animal):
+        return 'noise'
+
+    speak.add_method('animal')(lambda animal: 'grunt')
+    rewarmer = speak.enable_rewarming(max_keys=2)
+    assert speak.enable_rewarming() is rewarmer
+    for animal in ('dog', 'dog', 'dog', 'cat', 'cat', 'animal'):
+        speak(animal)
+    assert rewarmer.hottest() == ['dog', 'cat']
+
+    # The hottest values are cached again in the background
+    speak.add_method('animal')(lambda animal: 'growl')
+    deadline = time.time() + 5
+    while rewarmer.rounds < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    assert speak.method_cache['dog'] is speak.method_table['animal']
+    assert speak.method_cache['cat'] is speak.method_table['animal']
+    assert 'animal' not in speak.method_cache
+    assert speak('dog') == 'growl'
+
+    # Counts are kept for a bounded number of values
+    for i in xrange(100):
+        rewarmer.record(i)
+        rewarmer.record('dog')
+    assert len(rewarmer.counts) <= 4 * rewarmer.max_keys
+    assert rewarmer.hottest()[0] == 'dog'
+
+    speak.disable_rewarming()
+    assert speak.rewarmer is None
+    assert not rewarmer._thread.is_alive()
+    assert not hasattr(speak.dispatch_func, 'recorded')
+
+    @h.multimethod(lock=NullLock())
+    def unlocked(animal):
+        pass
+
+    @raises(ValueError)
+    def enable_without_locks():
+        unlocked.enable_rewarming()
+
+    enable_without_locks()
+
+    # Functions made by specialize count what they see, whenever they were made
+    from dispatchspec import key
+
+    @h.multimethod(key('kind'))
+    def feed(animal):
+        return 'scraps'
+
+    for multi, arg in ((speak, 'cat'), (feed, {'kind': 'cat'})):
+        call = multi.specialize()
+        rewarmer = multi.enable_rewarming()
+        call(arg)
+        multi(arg)
+        assert rewarmer.counts == {'cat': 2}
+        multi.disable_rewarming()
+        call(arg)
+        multi(arg)
+        assert rewarmer.counts == {'cat': 2}
+
+
+def test_dispatch_spec():
+    from operator import itemgetter
+    import dispatchspec
+    from dispatchspec import arg, attr, key, type_of
+
+    class Shape(object):
+        def __init__(self, kind):
+            self.kind = kind
+
+    h = hierarchy.Hierarchy()
+    h.derive({'shape': {'rect': {'square': None}, 'circle': None}})
+
+    @h.multimethod(key('type'))
+    def area(shape):
+        return 'unknown'
+
+    area.add_method('rect')(lambda shape: 'rect')
+    assert area({'type': 'square'}) == 'rect'
+    assert area({'type': 'line'}) == 'unknown'
+    # Compiled for the parameters of the default method, keywords included
+    assert area(shape={'type': 'square'}) == 'rect'
+    # Or to the builtin, for calls that pass a single argument positionally
+    assert isinstance(dispatchspec.compile_spec(key('type'), 1), itemgetter)
+
+    @h.multimethod((attr('kind'), key('type')))
+    def collide(a, b):
+        return 'default'
+
+    collide.add_method(('rect', 'shape'))(lambda a, b: 'rect with shape')
+    assert collide(Shape('square'), {'type': 'circle'}) == 'rect with shape'
+    call = collide.specialize()
+    assert call(Shape('square'), {'type': 'circle'}) == 'rect with shape'
+    assert call(Shape('circle'), {'type': 'circle'}) == 'default'
+    collide.add_method(('circle', 'shape'))(lambda a, b: 'circle with shape')
+    assert call(Shape('circle'), {'type': 'circle'}) == 'circle with shape'
+
+    # Positions, types and arguments themselves
+    @h.multimethod((key('type', arg=1), type_of(arg=0)))
+    def draw(canvas, shape):
+        return 'default'
+
+    draw.add_method(('rect', list))(lambda canvas, shape: 'rect on a list')
+    assert draw([], {'type': 'square'}) == 'rect on a list'
+    assert draw({}, {'type': 'square'}) == 'default'
+    assert draw([], shape={'type': 'square'}) == 'rect on a list'
+    assert draw.specialize()([], {'type': 'square'}) == 'rect on a list'
+
+    # Without a default method to go by, any arguments will do
+    names = multimethod.MultiMethod('names', arg(), hierarchy=h)
+    names.add_method('rect')(lambda shape, *rest, **kwargs: (rest, kwargs))
+    assert names('square', 1, x=2) == ((1,), {'x': 2})
+
+    @raises(ValueError)
+    def not_an_attribute():
+        attr('kind()')
+
+    not_an_attribute()
+
+    # A default that takes fewer arguments than the spec is a placeholder
+    @h.multimethod(key('type'))
+    def to_string():
+        pass
+
+    to_string.add_method('rect')(lambda shape: 'rect')
+    assert to_string({'type': 'square'}) == 'rect'
+
+    @h.multimethod((key('type'), key('type')))
+    def embed():
+        pass
+
+    embed.add_method(('rect', 'shape'))(lambda a, b, **kwargs: kwargs)
+    assert embed({'type': 'square'}, {'type': 'circle'}, size=10) == {'size': 10}
+
+
+def test_lazy_methods():
+    import os
+    import shutil
+    import sys
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    sys.path.insert(0, directory)
+    try:
+        with open(os.path.join(directory, 'lazyplugin.py'), 'w') as f:
+            f.write("def speak(animal):\n    return 'woof'\n")
+
+        for copy_on_write in (False, True):
+            sys.modules.pop('lazyplugin', None)
+            h = hierarchy.Hierarchy(copy_on_write=copy_on_write)
+            h.derive('puppy', 'dog')
+            h.derive('kitten', 'cat')
+
+            @h.multimethod()
+            def speak(animal):
+                return 'noise'
+
+            speak.add_lazy_method('dog', 'lazyplugin:speak')
+            speak.add_lazy_method('cat', 'lazyplugin:meow')
+            assert speak('rock') == 'noise'
+            assert 'lazyplugin' not in sys.modules
+            call = speak.specialize()
+            assert call('puppy') == 'woof'
+            assert 'lazyplugin' in sys.modules
+
+            # The function itself takes over from its stand-in, without a
+            # change to the method table
+            version = speak.method_table.__version__
+            func = sys.modules['lazyplugin'].speak
+            assert speak.method_table['dog'] is func
+            assert speak.get_method('puppy') is func
+            assert speak.method_cache['puppy'] is func
+            assert speak.method_table.__version__ == version
+
+            @raises(AttributeError)
+            def missing_function():
+                speak('kitten')
+
+            missing_function()
+    finally:
+        sys.path.remove(directory)
+        sys.modules.pop('lazyplugin', None)
+        shutil.rmtree(directory)
+
+    @raises(ValueError)
+    def no_function():
+        speak.add_lazy_method('dog', 'lazyplugin')
+
+    no_function()
@@ -0,0 +1,120 @@
+__author__ = 'wynand'
+
+# Warm-up profiles, to have multimethods resolve the dispatch values they are
+# going to see before the first request after a restart does.
+#
+# A profile holds, per multimethod name, the dispatch values in its cache and
+# the method table key each one went to. Take one from a process that has
+# been serving for a while with capture (or save, to write it to a file
+# straight away), and replay it at startup with warm, or warm_in_background
+# if the process should not wait for it. Capturing costs the running
+# multimethods nothing beyond the read locks it takes; it only looks at what
+# is cached. Tuples resolved through a factored multimethod's index are not
+# cached one by one and so are left out.
+#
+# Replaying a value resolves it through get_method, caching its method. A
+# value that no longer goes to the key it went to when captured, or that
+# cannot be resolved any more, is stale: the hierarchy or the method table
+# changed in between. Stale values are reported but cost no more than any
+# other, and the method cached for them is the current one.
+#
+# Profiles are pickled, so dispatch values and keys must be picklable; those
+# that are not are left out.
+
+import cPickle as pickle
+import threading
+
+from multimethod import ArgumentConflict
+
+VERSION = 1
+
+
+class Profile(object):
+    def __init__(self, entries=None):
+        # Multimethod name -> list of (dispatch value, key) pairs
+        self.entries = entries if entries is not None else {}
+
+    def __len__(self):
+        return sum(len(pairs) for pairs in self.entries.itervalues())
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'version': VERSION, 'entries': self.entries}, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if not isinstance(data, dict) or data.get('version') != VERSION:
+            raise ValueError("{0} is not a warm-up profile this version can read".format(path))
+        return cls(data['entries'])
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return True
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return False
+
+
+def capture(multimethods):
+    # Returns the Profile of what multimethods, which need distinct names,
+    # have cached.
+    profile = Profile()
+    for mm in multimethods:
+        if mm.name in profile.entries:
+            raise ValueError("Multimethods in a profile need distinct names")
+        with mm.rw.read(), mm.hierarchy.rw.read():
+            dispatch_vals = list(mm.method_cache.keys())
+            if mm.type_cache is not None:
+                dispatch_vals.extend(mm.type_cache.keys())
+            pairs = list(mm._resolve_keys(dispatch_vals))
+        profile.entries[mm.name] = [(dispatch_val, key) for dispatch_val, key in pairs
+                                    if _picklable(dispatch_val) and _picklable(key)]
+    return profile
+
+
+def save(path, multimethods):
+    profile = capture(multimethods)
+    profile.save(path)
+    return profile
+
+
+def warm(profile, multimethods):
+    # Resolves the dispatch values that profile (a Profile or the path of a
+    # saved one) holds for multimethods. Returns a dict with the number of
+    # values resolved as 'warmed' and the (name, dispatch value) pairs of the
+    # stale ones as 'stale'.
+    if not isinstance(profile, Profile):
+        profile = Profile.load(profile)
+    warmed = 0
+    stale = []
+    for mm in multimethods:
+        for dispatch_val, key in profile.entries.get(mm.name, ()):
+            try:
+                target_func = mm.get_method(dispatch_val)
+            except (ArgumentConflict, NotImplementedError, TypeError):
+                stale.append((mm.name, dispatch_val))
+                continue
+            warmed += 1
+            # Whatever key it goes to now has this method
+            if mm.method_table.get(key) is not target_func:
+                stale.append((mm.name, dispatch_val))
+    return {'warmed': warmed, 'stale': stale}
+
+
+def warm_in_background(profile, multimethods, on_done=None):
+    # Runs warm in a daemon thread, which it returns started. on_done, if
+    # given, gets the result of warm once it is done.
+    multimethods = list(multimethods)
+
+    def run():
+        result = warm(profile, multimethods)
+        if on_done is not None:
+            on_done(result)
+
+    thread = threading.Thread(target=run, name='multimethod-warmup')
+    thread.daemon = True
+    thread.start()
+    return thread